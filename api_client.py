@@ -0,0 +1,251 @@
+"""Shared HTTP client for every YouTube Data API request.
+
+channel_scraper, finish_data and update_data all make their API requests
+through api_get. The requests go through one requests.Session, so the
+TCP and TLS connections to the API are pooled and kept alive between
+requests instead of being opened again for every request.
+
+Requests that fail with a status code in RETRY_STATUS_CODES, or that fail
+to connect, are retried up to MAX_RETRIES times. Between attempts the
+client waits for the time given in the 'Retry-After' header, or otherwise
+for an exponential backoff with full jitter.
+
+Responses are read from and stored in the on-disk cache of
+response_cache, so repeated requests do not spend quota. Expired
+responses, and channels and uploads pages on every revisit, are
+revalidated with their ETag: a 304 Not Modified answer
+reuses the stored body, so an unchanged page is neither downloaded nor
+parsed again. A 304 is still counted at the full cost in quota.py.
+
+api_get adds the API key to every request it sends, chosen by the quota
+module, records the units the request cost and moves on to the next key
+when the API reports a key as out of quota.
+
+Response bodies are decoded with orjson when it is installed, which is
+several times faster than the json module on large pages, and with json
+otherwise. Either way the bytes received are decoded once, without
+requests decoding them to text first.
+
+The latency of every attempt, the bytes received, the retries, the cache
+hits and the quota spent are recorded by endpoint in metrics.py.
+
+Attributes:
+    API_BASE_URL (str):
+        The url every endpoint name is appended to.
+
+    POOL_SIZE (int):
+        The number of keep-alive connections to hold open. This should be
+        at least channel_scraper.MAX_WORKERS.
+
+    REQUEST_TIMEOUT (float):
+        The number of seconds to wait for the API before giving up
+        on an attempt.
+
+    MAX_RETRIES (int):
+        The number of times a failed request is retried.
+
+    BACKOFF_BASE (float):
+        The number of seconds the backoff starts from. It doubles after
+        every attempt.
+
+    BACKOFF_MAX (float):
+        The most seconds to wait between two attempts.
+
+    RETRY_STATUS_CODES (set of int):
+        The status codes which are worth retrying.
+"""
+
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import get_metrics
+from quota import UNIT_COSTS, get_quota, is_quota_error
+from response_cache import cache_key, cache_ttl, get_cache
+
+try:
+    from orjson import loads as json_loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    from json import loads as json_loads
+    JSON_BACKEND = "json"
+
+# variables
+API_BASE_URL = "https://www.googleapis.com/youtube/v3/"
+POOL_SIZE = 16
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 64.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+
+class ApiError(Exception):
+    """The API answered with an error body instead of the data asked for."""
+
+
+class RateLimited(ApiError):
+    """The API still answered 429 Too Many Requests after every retry."""
+
+
+def api_get(endpoint, params, use_cache = True):
+    """Make a GET request to an endpoint of the YouTube Data API and
+    return the decoded json response.
+
+    Args:
+        endpoint (str): the name of the endpoint, e.g. "videos".
+
+        params (dict): the query parameters of the request, without
+                       the API key.
+
+        use_cache (bool): False to always ask the API, and not store
+                          the response either.
+    Returns:
+        dict: the json response. Error responses from the API are
+              returned as well, so callers can report them.
+    Raises:
+        quota.QuotaExhausted: every API key is out of quota for the day.
+
+        RateLimited: the API kept answering 429 after MAX_RETRIES
+                     retries.
+    """
+
+    metrics = get_metrics()
+    ttl = cache_ttl(endpoint, params) if use_cache else None
+    cache = get_cache() if ttl is not None else None
+    stale = None
+    headers = None
+    if cache is not None:
+        key = cache_key(endpoint, params)
+        body = cache.get(key)
+        if body is not None:
+            metrics.count("api_cache_hits", endpoint = endpoint)
+            with metrics.timer("json_decode_seconds", endpoint = endpoint):
+                return json_loads(body)
+        stale = cache.get_stale(key)
+        if stale is not None:
+            headers = {"If-None-Match": stale[1]}
+
+    quota = get_quota()
+    while True:
+        api_key = quota.key_for(UNIT_COSTS.get(endpoint, 1))
+        request_link = (API_BASE_URL + endpoint + "?"
+                        + urlencode(dict(params, key = api_key)))
+        response = get_with_retries(request_link, endpoint, headers)
+        quota.spend(api_key, endpoint)
+        metrics.count("quota_units_spent", UNIT_COSTS.get(endpoint, 1),
+                      endpoint = endpoint)
+        metrics.count("api_responses", endpoint = endpoint,
+                      status = response.status_code)
+        metrics.count("api_bytes_received", len(response.content),
+                      endpoint = endpoint)
+        if response.status_code == 403 and is_quota_error(decode(response)):
+            # raises QuotaExhausted once no key is left
+            print("\nAPI key is out of quota, moving to the next key")
+            quota.mark_exhausted(api_key)
+            continue
+        break
+    if response.status_code == 429:
+        raise RateLimited(f"{endpoint}: status_code 429, too_many_requests "\
+                          f"after {MAX_RETRIES} retries")
+    if response.status_code == 304 and stale is not None:
+        # unchanged since the stored response
+        cache.refresh(key, ttl)
+        metrics.count("api_not_modified", endpoint = endpoint)
+        with metrics.timer("json_decode_seconds", endpoint = endpoint):
+            return json_loads(stale[0])
+    with metrics.timer("json_decode_seconds", endpoint = endpoint):
+        body = json_loads(response.content)
+    if cache is not None and response.status_code == 200:
+        cache.put(key, endpoint, response.content.decode("utf-8"), ttl,
+                  response_etag(response, body))
+    return body
+
+def response_etag(response, body):
+    # the ETag header, or the etag of the json body
+    etag = response.headers.get("ETag")
+    if etag:
+        return etag
+    if isinstance(body, dict):
+        return body.get("etag")
+    return None
+
+def decode(response):
+    # the json of a response, or None if it is not json
+    try:
+        return json_loads(response.content)
+    except ValueError:
+        return None
+
+def get_with_retries(request_link, endpoint = None, headers = None):
+
+    session = get_session()
+    metrics = get_metrics()
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            response = session.get(request_link, headers = headers,
+                                   timeout = REQUEST_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            if attempt >= MAX_RETRIES:
+                raise
+            wait = backoff_delay(attempt)
+            print(f"\n{type(error).__name__}, retrying in {wait:.1f}s")
+            reason = type(error).__name__
+        else:
+            metrics.observe("api_request_seconds",
+                            time.perf_counter() - start, endpoint = endpoint)
+            if (response.status_code not in RETRY_STATUS_CODES
+                    or attempt >= MAX_RETRIES):
+                return response
+            wait = retry_after_delay(response)
+            if wait is None:
+                wait = backoff_delay(attempt)
+            print(f"\nstatus_code {response.status_code}, "\
+                  f"retrying in {wait:.1f}s")
+            reason = response.status_code
+        metrics.count("api_retries", endpoint = endpoint, reason = reason)
+        time.sleep(wait)
+        attempt += 1
+
+def get_session():
+
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections = POOL_SIZE,
+                                  pool_maxsize = POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            SESSION = session
+        return SESSION
+
+def backoff_delay(attempt):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def retry_after_delay(response):
+    # 'Retry-After' is either a number of seconds or an http date
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
@@ -0,0 +1,324 @@
+"""Benchmark the scraper, finisher and updater against a local mock API.
+
+benchmark runs the three scripts of the module against MockYouTubeAPI
+(see mock_youtube_api.py), in a temporary directory, without spending
+any quota:
+
+    scrape  datamine_multiple_channels on new channels
+    finish  finish_data on channels that were started and interrupted
+    resume  a datamine_multiple_channels that crashes part way through
+            a channel, then finish_data and datamine_multiple_channels
+            again, like 'python cli.py resume'
+    update  update_all_data once new videos were uploaded to every
+            channel mined so far
+
+For each phase it reports the requests per second, the videos datamined
+per second, the peak resident memory of the process so far and the quota
+units spent per video, so a change that slows the module down, or makes
+it spend more quota, shows up. The mock API runs in the same process, its
+memory is counted in the peak too.
+
+After each phase every channel mined so far must be finished, with one
+row per upload of the mock API and no video twice, or the benchmark
+stops with OutputMismatch, so a change that is fast because it drops or
+repeats rows does not go unnoticed.
+
+Example:
+    python benchmark.py --channels 10,1000,100000 --latency 0.02 \\
+                        --max-workers 4 --json results.json
+"""
+
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+from itertools import count
+
+import api_client
+import channel_scraper
+from channel_scraper import (CHANNELS_IN_PROGRESS, CHANNELS_LOCK, csv_writer,
+                             datamine_channel, datamine_multiple_channels,
+                             find_channel_vids)
+from config import Config
+from delta_segments import iter_rows
+from finish_data import finish_data
+from metrics import get_metrics
+from mock_youtube_api import (MockYouTubeAPI, channel_number, channel_title,
+                              parse_video_id)
+from output_writers import is_channel_file
+from quota import get_quota
+from update_data import update_all_data
+
+
+class OutputMismatch(Exception):
+    # The files of a phase do not hold what the mock API has.
+    pass
+
+class Crash(Exception):
+    # Raised in place of a write, like a run killed part way through.
+    pass
+
+
+def run_benchmark(arguments):
+    """Run every phase of the benchmark and return its results.
+
+    Args:
+        arguments (argparse.Namespace): the options of the benchmark,
+                                        see parse_arguments.
+    Returns:
+        list of dict: the measures of each phase.
+    """
+
+    api = MockYouTubeAPI(arguments.latency, arguments.error_rate,
+                         arguments.rate_limit_rate)
+    api_client.API_BASE_URL = api.start()
+    api_client.BACKOFF_BASE = arguments.backoff_base
+
+    config = Config(API_KEYS = ["benchmark-key"],
+                    MAX_VIDEOS = arguments.max_videos,
+                    MAX_WORKERS = arguments.max_workers,
+                    OUTPUT_FORMAT = arguments.output_format,
+                    CACHE_PATH = Config.CACHE_PATH if arguments.cache else "")
+    os.makedirs(config.UNFINISHED_PATH)
+    os.makedirs(os.path.dirname(config.CHANNEL_LINKS_TEXT_FILEPATH))
+    # the mock API has no daily limit, neither should the benchmark
+    get_quota(config.API_KEYS, config.QUOTA_PATH).daily_quota = 10 ** 12
+
+    results = []
+    scrape_links = [api.add_channel(video_count)
+                    for video_count in parse_counts(arguments.channels)]
+    with open(config.CHANNEL_LINKS_TEXT_FILEPATH, "a") as file:
+        file.writelines(link + "\n" for link in scrape_links)
+    results.append(measure("scrape", api, config, arguments.verbose,
+                           datamine_multiple_channels, config))
+    check_output("scrape", api, config, scrape_links)
+
+    finish_links = [api.add_channel(video_count) for video_count
+                    in parse_counts(arguments.finish_channels)]
+    with quiet(arguments.verbose):
+        for channel_link in finish_links:
+            start_channel(channel_link, config, arguments.finish_batches)
+    results.append(measure("finish", api, config, arguments.verbose,
+                           finish_data, config))
+    check_output("finish", api, config, scrape_links + finish_links)
+
+    crash_links = [api.add_channel(video_count) for video_count
+                   in parse_counts(arguments.crash_channels)]
+    with open(config.CHANNEL_LINKS_TEXT_FILEPATH, "a") as file:
+        file.writelines(link + "\n" for link in crash_links)
+    results.append(measure("resume", api, config, arguments.verbose,
+                           crash_and_resume, config,
+                           arguments.crash_batches))
+    mined_links = scrape_links + finish_links + crash_links
+    check_output("resume", api, config, mined_links)
+
+    # update_all_data updates the channel files, a channel mined without
+    # uploads has none and gets no new uploads
+    mined_links = [channel_link for channel_link in mined_links
+                   if api.channels[link_number(channel_link)]]
+    for channel_link in mined_links:
+        api.add_uploads(channel_link, arguments.new_uploads)
+    results.append(measure("update", api, config, arguments.verbose,
+                           update_all_data, config))
+    check_output("update", api, config, mined_links)
+    api.stop()
+    get_metrics().flush()
+    return results
+
+def measure(phase, api, config, verbose, function, *args):
+    # Call function(*args) and measure it.
+    requests_before = api.stats.get("requests", 0)
+    videos_before = api.stats.get("video_statistics", 0)
+    units_before = units_spent(config)
+    with quiet(verbose):
+        start = time.perf_counter()
+        function(*args)
+        seconds = time.perf_counter() - start
+    requests = api.stats.get("requests", 0) - requests_before
+    videos = api.stats.get("video_statistics", 0) - videos_before
+    units = units_spent(config) - units_before
+    return {"phase": phase,
+            "seconds": round(seconds, 3),
+            "requests": requests,
+            "videos": videos,
+            "requests_per_second": round(requests / seconds, 1),
+            "videos_per_second": round(videos / seconds, 1),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "units": units,
+            "units_per_video": round(units / videos, 4) if videos else None}
+
+def start_channel(channel_link, config, batches):
+    # Datamine the first 'batches' writes of a channel and stop, like
+    # a run of channel_scraper that was interrupted.
+    vid_list, channel_name, channel_id = find_channel_vids(channel_link,
+                                                           config)
+    try:
+        for i, finished_vid_list in enumerate(datamine_channel(vid_list,
+                                                               config)):
+            csv_writer(finished_vid_list, channel_name, channel_id, config)
+            if i + 1 >= batches:
+                break
+    finally:
+        get_quota().release(channel_id)
+        with CHANNELS_LOCK:
+            CHANNELS_IN_PROGRESS.discard(channel_id)
+
+def crash_and_resume(config, batches):
+    # Scrape until 'batches' writes were made and crash, then finish the
+    # files the crash left and scrape the rest of the queue.
+    try:
+        with crashing_after(batches):
+            datamine_multiple_channels(config)
+    except Crash:
+        pass
+    finish_data(config)
+    datamine_multiple_channels(config)
+
+@contextmanager
+def crashing_after(writes):
+    # Make channel_scraper raise Crash instead of writing, once it made
+    # 'writes' writes.
+    csv_writer = channel_scraper.csv_writer
+    written = count()
+    def crashing_writer(*args, **kwargs):
+        if next(written) >= writes:
+            raise Crash(f"crashed after {writes} writes")
+        return csv_writer(*args, **kwargs)
+    channel_scraper.csv_writer = crashing_writer
+    try:
+        yield
+    finally:
+        channel_scraper.csv_writer = csv_writer
+
+def check_output(phase, api, config, channel_links):
+    # Raise OutputMismatch unless every channel of channel_links has
+    # been finished with one row per upload, and no other channel has
+    # any row.
+    unfinished = [file for file in os.listdir(config.UNFINISHED_PATH)
+                  if is_channel_file(file)]
+    if unfinished:
+        raise OutputMismatch(f"{phase}: {len(unfinished)} channel files "\
+                             f"left in {config.UNFINISHED_PATH}")
+    vid_ids = {} # channel number -> ids of its rows
+    for file in os.listdir(config.OUTPUT_PATH):
+        if is_channel_file(file):
+            for row in iter_rows(os.path.join(config.OUTPUT_PATH, file)):
+                number, upload = parse_video_id(row[0])
+                vid_ids.setdefault(number, []).append(row[0])
+    for channel_link in channel_links:
+        number = link_number(channel_link)
+        channel_ids = vid_ids.pop(number, [])
+        if len(channel_ids) != api.channels[number]:
+            raise OutputMismatch(f"{phase}: {channel_title(number)} has "\
+                                 f"{len(channel_ids)} rows for "\
+                                 f"{api.channels[number]} uploads")
+        if len(set(channel_ids)) != len(channel_ids):
+            raise OutputMismatch(f"{phase}: {channel_title(number)} has "\
+                                 f"{len(channel_ids) - len(set(channel_ids))}"\
+                                 " duplicate rows")
+    if vid_ids:
+        raise OutputMismatch(f"{phase}: rows of {len(vid_ids)} channels "\
+                             "that were not mined")
+
+def link_number(channel_link):
+    return channel_number(channel_link.rsplit("/",1)[-1])
+
+def units_spent(config):
+    return sum(get_quota().spent(api_key) for api_key in config.API_KEYS)
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+@contextmanager
+def quiet(verbose):
+    # the scripts print a lot, which would hide the results
+    if verbose:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        yield
+
+def parse_counts(value):
+    return [int(count) for count in value.split(",") if count.strip()]
+
+def print_results(results):
+
+    columns = ["phase", "seconds", "requests", "videos",
+               "requests_per_second", "videos_per_second", "peak_rss_mb",
+               "units_per_video"]
+    print("\n" + "  ".join(f"{column:>19}" for column in columns))
+    for result in results:
+        print("  ".join(f"{str(result[column]):>19}" for column in columns))
+
+def parse_arguments(argv = None):
+
+    parser = argparse.ArgumentParser(description = "Benchmark the scraper "
+                                     "against a local mock of the API.")
+    parser.add_argument("--channels", default = "10,1000,10000",
+                        help = "upload counts of the channels to scrape, "
+                               "comma separated")
+    parser.add_argument("--finish-channels", default = "1000,10000",
+                        help = "upload counts of the channels to finish")
+    parser.add_argument("--finish-batches", type = int, default = 1,
+                        help = "writes done before a channel to finish "
+                               "is interrupted")
+    parser.add_argument("--crash-channels", default = "3000,200",
+                        help = "upload counts of the channels to scrape "
+                               "in the run that crashes")
+    parser.add_argument("--crash-batches", type = int, default = 2,
+                        help = "writes done before the run crashes")
+    parser.add_argument("--new-uploads", type = int, default = 120,
+                        help = "videos uploaded to every channel "
+                               "before the update")
+    parser.add_argument("--latency", type = float, default = 0.0,
+                        help = "seconds the mock API takes per request")
+    parser.add_argument("--error-rate", type = float, default = 0.0,
+                        help = "share of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type = float, default = 0.0,
+                        help = "share of requests answered with a 429")
+    parser.add_argument("--backoff-base", type = float, default = 0.05,
+                        help = "api_client.BACKOFF_BASE for the run")
+    parser.add_argument("--max-videos", type = int, default = Config.MAX_VIDEOS)
+    parser.add_argument("--max-workers", type = int,
+                        default = Config.MAX_WORKERS)
+    parser.add_argument("--output-format", default = Config.OUTPUT_FORMAT)
+    parser.add_argument("--cache", action = "store_true",
+                        help = "use the response cache")
+    parser.add_argument("--keep", action = "store_true",
+                        help = "keep the temporary directory")
+    parser.add_argument("--verbose", action = "store_true",
+                        help = "show the output of the scripts")
+    parser.add_argument("--json", help = "write the results to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+
+    arguments = parse_arguments()
+    if arguments.json:
+        arguments.json = os.path.abspath(arguments.json)
+    # every database and file of the run goes in a temporary directory
+    directory = tempfile.mkdtemp(prefix = "yt_benchmark_")
+    os.chdir(directory)
+    try:
+        results = run_benchmark(arguments)
+    finally:
+        if arguments.keep:
+            print(f"\nthe files of the run are in {directory}")
+        else:
+            os.chdir(tempfile.gettempdir())
+            shutil.rmtree(directory, ignore_errors = True)
+    print_results(results)
+    if arguments.json:
+        with open(arguments.json, "w") as file:
+            json.dump(results, file, indent = 2)
@@ -0,0 +1,363 @@
+"""Build one dataset out of every finished channel file.
+
+The data of each channel is in its own file in 'OUTPUT_PATH', plus the
+delta segments update_data added to it (see delta_segments.py).
+build_dataset streams all of them into one corpus in 'DATASET_PATH':
+
+    dataset/part-00000.csv ... part-00063.csv   the videos, a partition
+                                                per group of channels
+    dataset/index.sqlite                        the video id index and
+                                                the manifest of the build
+
+The partitions are written in 'OUTPUT_FORMAT'. Every row starts with the
+channel_id and channel_name of its channel, which the channel files lack.
+The channel_id is read from the channel state store (see channel_state.py)
+or, for a channel it does not know, looked up like update_data does. All
+the rows of a channel go to the partition its channel_id hashes to,
+newest video first.
+
+A video found in more than one file, e.g. a channel mined twice under two
+names, is only written once: the index maps every video id to the channel
+and partition it was written to (find), and a video already in it is
+skipped.
+
+The manifest records the mtime and size of the files of every channel and
+a checksum of their content. A build only rewrites the partitions holding
+a channel whose files were added, removed or changed since the last
+build. A file whose mtime changed but not its checksum is not
+reprocessed. A partition is written under a temporary name and renamed
+into place before its part of the index is committed, so an interrupted
+build is finished by the next one. Delete 'DATASET_PATH' to build the
+dataset again from scratch.
+
+Attributes:
+    PARTITIONS (int):
+        The number of partitions the channels are hashed into. Changing
+        it needs a build from scratch.
+
+    PARQUET_BATCH_ROWS (int):
+        The number of rows buffered before they are written to a parquet
+        partition, as one row group.
+"""
+
+
+import csv
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+from contextlib import closing
+from datetime import datetime
+
+from channel_state import Transaction, get_store
+from config import load_config
+from delta_segments import iter_rows, list_segments
+from finish_data import get_file_list
+from metrics import get_metrics
+from output_writers import (ParquetOutput, get_output_writer,
+                            get_output_writer_for, parse_date, pa, pq)
+from quota import get_quota
+from response_cache import get_cache, print_cache_stats
+from update_data import channel_name_of, find_channel_ids, get_first_vid_id
+
+# variables
+PARTITIONS = 64
+PARQUET_BATCH_ROWS = 100000
+
+INDEX_FILENAME = "index.sqlite"
+CHECKSUM_BLOCK_SIZE = 1 << 20
+
+
+class DatasetIndex(object):
+
+    def __init__(self, path):
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout = 60,
+                                          check_same_thread = False,
+                                          isolation_level = None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS videos ("
+            " vid_id TEXT PRIMARY KEY,"
+            " channel_id TEXT NOT NULL,"
+            " part INTEGER NOT NULL) WITHOUT ROWID")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS videos_part ON videos (part)")
+        # the manifest, one row per channel file of the last build
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS channels ("
+            " path TEXT PRIMARY KEY,"
+            " channel_name TEXT NOT NULL,"
+            " channel_id TEXT NOT NULL,"
+            " part INTEGER NOT NULL,"
+            " signature TEXT NOT NULL,"
+            " checksum TEXT NOT NULL)")
+
+    def transaction(self):
+        return Transaction(self)
+
+    def manifest(self):
+        # {path: row as a dict} of every channel file of the last build
+        with self.lock:
+            cursor = self.connection.execute("SELECT * FROM channels")
+            columns = [description[0] for description in cursor.description]
+            return {row[0]: dict(zip(columns, row)) for row in cursor}
+
+    def find(self, vid_id):
+        # (channel id, partition) of a video, or None if it is not in
+        # the dataset.
+        with self.lock:
+            return self.connection.execute(
+                "SELECT channel_id, part FROM videos WHERE vid_id = ?",
+                (vid_id,)).fetchone()
+
+    def record_signature(self, path, signature):
+        # for a file touched without being changed
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE channels SET signature = ? WHERE path = ?",
+                (signature, path))
+
+
+class CsvPartition(object):
+
+    def __init__(self, path, header):
+
+        self.file = open(path, "w", newline = "")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)
+
+    def write(self, row):
+        # parquet channel files hold the date as a datetime
+        if isinstance(row[4], datetime):
+            row[4] = row[4].strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetPartition(object):
+
+    def __init__(self, path, header):
+
+        schema = ParquetOutput().schema(header[2:])
+        self.schema = pa.schema([pa.field("channel_id", pa.string()),
+                                 pa.field("channel_name", pa.string())]
+                                + list(schema))
+        self.writer = pq.ParquetWriter(path, self.schema,
+                                       use_dictionary = True)
+        self.rows = []
+
+    def write(self, row):
+        # csv channel files hold every value as a string
+        if isinstance(row[4], str):
+            row[4] = parse_date(row[4]) if row[4] else None
+        for i in range(6, len(row)):
+            if isinstance(row[i], str):
+                row[i] = int(row[i]) if row[i] else None
+        self.rows.append(row)
+        if len(self.rows) >= PARQUET_BATCH_ROWS:
+            self.write_batch()
+
+    def write_batch(self):
+
+        if not self.rows:
+            return
+        columns = [list(column) for column in zip(*self.rows)]
+        self.writer.write_table(pa.Table.from_arrays(columns,
+                                                     schema = self.schema))
+        self.rows = []
+
+    def close(self):
+
+        self.write_batch()
+        self.writer.close()
+
+
+PARTITION_WRITERS = {"csv": CsvPartition, "parquet": ParquetPartition}
+
+
+def build_dataset(config):
+    """Write the rows of every channel file in the 'OUTPUT_PATH' directory,
+    and of their delta segments, to the partitions of the dataset in
+    'DATASET_PATH'. Only the partitions of channels whose files changed
+    since the last build are written again.
+
+    Args:
+        config (Config): the settings of the run, see config.py. The
+                         dataset is written to its DATASET_PATH, in its
+                         OUTPUT_FORMAT, with its RELEVANT_DATA columns.
+    Returns:
+        int: the number of partitions written.
+    """
+
+    print("\n\nstarting build_dataset")
+    get_metrics(config.METRICS_LOG_PATH, config.PROMETHEUS_PATH)
+    get_cache(config.CACHE_PATH)
+    get_output_writer(config.OUTPUT_FORMAT) # fails early without pyarrow
+    get_store(config.COMPLETED_LINKS_FILEPATH, config.CHANNEL_STATE_PATH)
+    index = DatasetIndex(os.path.join(config.DATASET_PATH, INDEX_FILENAME))
+    manifest = index.manifest()
+
+    entries = {}
+    changed = []
+    for file in get_file_list(config.OUTPUT_PATH):
+        signature = channel_signature(file)
+        entry = manifest.get(file)
+        if entry is not None and entry["signature"] == signature:
+            entries[file] = entry
+            continue
+        checksum = channel_checksum(file)
+        if entry is not None and entry["checksum"] == checksum:
+            print(f"\n{file} was touched but did not change")
+            index.record_signature(file, signature)
+            entries[file] = entry
+            continue
+        changed.append(file)
+        entries[file] = {"path": file, "channel_name": channel_name_of(file),
+                         "signature": signature, "checksum": checksum}
+    print(f"\n{len(changed)} of {len(entries)} channel files are new "\
+          "or changed")
+
+    # a changed file keeps the channel it had, the others are looked up
+    channel_ids = {file: manifest[file]["channel_id"]
+                   for file in changed if file in manifest}
+    unknown = [file for file in changed if file not in channel_ids]
+    channel_ids.update(find_channel_ids({file: get_first_vid_id(file)
+                                         for file in unknown}))
+
+    dirty_parts = set()
+    for file in changed:
+        if file in manifest:
+            dirty_parts.add(manifest[file]["part"])
+        if file not in channel_ids:
+            print(f"\nno channel found for {file}, leaving it out")
+            del entries[file]
+            continue
+        entries[file]["channel_id"] = channel_ids[file]
+        entries[file]["part"] = partition_of(channel_ids[file])
+        dirty_parts.add(entries[file]["part"])
+    for file, entry in manifest.items():
+        if file not in entries:
+            print(f"\n{file} was removed")
+            dirty_parts.add(entry["part"])
+
+    header = ["channel_id", "channel_name", "id", "title", "date",
+              "thumbnail"] + config.RELEVANT_DATA
+    for part in sorted(dirty_parts):
+        part_entries = sorted((entry for entry in entries.values()
+                               if entry["part"] == part),
+                              key = lambda entry: entry["path"])
+        write_partition(index, part, part_entries, header, config)
+    print(f"\n{len(dirty_parts)} partitions written to "\
+          f"{config.DATASET_PATH}")
+    return len(dirty_parts)
+
+def write_partition(index, part, entries, header, config):
+    # Write every row of the channels of one partition, skipping the
+    # videos the index already has, and replace its part of the index.
+    path = partition_path(config, part)
+    with index.transaction() as connection:
+        connection.execute("DELETE FROM videos WHERE part = ?", (part,))
+        connection.execute("DELETE FROM channels WHERE part = ?", (part,))
+        if not entries:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        temp_path = path + ".tmp"
+        partition = PARTITION_WRITERS[config.OUTPUT_FORMAT](temp_path,
+                                                            header)
+        written = 0
+        duplicates = 0
+        try:
+            for entry in entries:
+                prefix = [entry["channel_id"], entry["channel_name"]]
+                columns = column_positions(entry["path"], header[2:])
+                with closing(iter_rows(entry["path"])) as rows:
+                    for row in rows:
+                        cursor = connection.execute(
+                            "INSERT OR IGNORE INTO videos VALUES (?, ?, ?)",
+                            (row[0], entry["channel_id"], part))
+                        if not cursor.rowcount:
+                            duplicates += 1
+                            continue
+                        partition.write(prefix + [
+                            row[i] if i is not None else None
+                            for i in columns])
+                        written += 1
+                connection.execute(
+                    "INSERT OR REPLACE INTO channels VALUES"
+                    " (?, ?, ?, ?, ?, ?)",
+                    (entry["path"], entry["channel_name"],
+                     entry["channel_id"], part, entry["signature"],
+                     entry["checksum"]))
+        finally:
+            partition.close()
+        os.replace(temp_path, path)
+    print(f"\n{path}: {written} videos of {len(entries)} channels, "\
+          f"{duplicates} duplicates left out")
+
+def column_positions(file, columns):
+    # The position of each column in the rows of file, None for a
+    # column it does not have, e.g. a metric added to RELEVANT_DATA since.
+    file_header = get_output_writer_for(file).header(file)
+    return [file_header.index(name) if name in file_header else None
+            for name in columns]
+
+def partition_of(channel_id):
+    # crc32, unlike hash(), is the same in every run
+    return zlib.crc32(channel_id.encode("utf-8")) % PARTITIONS
+
+def partition_path(config, part):
+
+    extension = get_output_writer(config.OUTPUT_FORMAT).extension
+    return os.path.join(config.DATASET_PATH, f"part-{part:05d}{extension}")
+
+def channel_paths(file):
+    # Every file holding rows of a channel: its delta segments and its
+    # base file, and the parts of those that are parquet directories.
+    output_writer = get_output_writer_for(file)
+    paths = []
+    for path in list_segments(file) + [file]:
+        if os.path.isdir(path):
+            paths += output_writer.parts(path)
+        else:
+            paths.append(path)
+    return paths
+
+def channel_signature(file):
+    # changes whenever a file of the channel is added, rewritten or
+    # appended to
+    signature = []
+    for path in channel_paths(file):
+        stat = os.stat(path)
+        signature.append(f"{os.path.basename(path)}:{stat.st_mtime_ns}:"\
+                         f"{stat.st_size}")
+    return ";".join(signature)
+
+def channel_checksum(file):
+
+    checksum = hashlib.blake2b(digest_size = 16)
+    for path in channel_paths(file):
+        checksum.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as channel_file:
+            for block in iter(lambda: channel_file.read(CHECKSUM_BLOCK_SIZE),
+                              b""):
+                checksum.update(block)
+    return checksum.hexdigest()
+
+
+if __name__ == "__main__":
+    config = load_config(description = "Build one partitioned dataset out "
+                                       "of the channel files in OUTPUT_PATH.")
+    get_quota(config.API_KEYS, config.QUOTA_PATH)
+    build_dataset(config)
+    print_cache_stats()
+    get_metrics().flush()
@@ -18,77 +18,89 @@ File Writing:
     To complete an unfinished channel use the finish_data.py module.
     To update data use the update_data.py module.
 
-Attributes:
-    API_KEY_PATH (str): 
-        The filepath for a .txt file where the first line is your API key. 
-
-    CHANNEL_LINKS_TEXT_FILEPATH (str): 
-        The filepath for a .txt file where each line is a link to 
-        a YouTube channel.
-
-    OUTPUT_PATH (str):
-        The directory where the completed data should go. 
-    
-    UNFINISHED_PATH (str):
-        The directory where the incomplete data should go.
-    
-    COMPLETED_LINKS_FILEPATH (str):
-        The filepath to a .txt file which contains the links
-        to all channels which have been partially or fully
-        data-mined. This is necessary to prevent duplicate data.
-    
-    MAX_VIDEOS (int):
-        The number of videos the module should datamine at a time before
-        writing the data to a csv file. It should be noted that the module
-        will always write the csv file when it completes a channel.
-    
-    RELEVANT_DATA (list of str):
-        The data that json_parse() should look for. Metrics can be removed
-        if they are not deemed relevant to write to the csv file. Removing a
-        metric will not save API quota cost. 
-
+Sharded runs:
+    Runs on several machines can share the channels of one work queue:
+    point their WORK_QUEUE_PATH and CHANNEL_STATE_PATH at the same
+    databases and give each its own WORKER_ID and UNFINISHED_PATH. Every
+    run claims links from the queue and channels from the store under
+    leases (see work_queue.py and channel_state.py), which a heartbeat
+    thread renews while it runs. The links and channels of a run that
+    died are taken over once their leases expire, and a run that finds
+    its channel was taken over moves its file to 'UNFINISHED_PATH'
+    abandoned/ instead of finishing it, so no row is written twice.
+
+Configuration:
+    The settings of a run (API keys, paths, MAX_VIDEOS, RELEVANT_DATA...)
+    are loaded once at startup into a Config object, see config.py, and
+    passed to the functions of this module. They can be overridden from
+    the environment or the command line, e.g.
+    python channel_scraper.py --max-workers 4
+
+Requests only ask for the fields the module reads (the 'fields'
+parameter, see PLAYLIST_ITEMS_FIELDS), so the API sends, and the module
+decodes, a fraction of the full responses.
 
+Attributes:
+    VIDEOS_PER_REQUEST (int):
+        The most video ids the API accepts in one videos request.
 
+    PLAYLIST_ITEMS_FIELDS, CHANNELS_FIELDS, VIDEO_CHANNEL_FIELDS (str):
+        The fields of the playlistItems and channels responses, and of
+        the videos responses used to find the channel of a video, the
+        module reads. A field missing here is missing from the responses.
 """
 
 
-import csv
-import json
 import os
-import requests
-import sys
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain, islice
+
+from api_client import ApiError, RateLimited, api_get
+from channel_state import ChannelLeased, LeaseLost, get_store
+from config import load_config
+from metrics import get_metrics, timed
+from output_writers import get_output_writer
+from quota import (OverBudget, QuotaExhausted, charge_to, charged_channel,
+                   estimate_channel_cost, get_quota)
+from work_queue import LEASE_SECONDS, get_queue
+from response_cache import get_cache, print_cache_stats
+from run_journal import get_journal
 
 # variables
-API_KEY_PATH = "api_key.txt"
-CHANNEL_LINKS_TEXT_FILEPATH = "channel_links/channel_links.txt"
-OUTPUT_PATH = "data/"
-UNFINISHED_PATH = "data/unfinished/"
-COMPLETED_LINKS_FILEPATH = "channel_links/completed_channel_links.txt"
+VIDEOS_PER_REQUEST = 50 # the most ids the API accepts in one videos request
+PLAYLIST_ITEMS_FIELDS = "etag,nextPageToken,items/snippet(channelTitle,"\
+                        "title,publishedAt,resourceId/videoId,"\
+                        "thumbnails/default/url)"
+CHANNELS_FIELDS = "etag,items(id,contentDetails/relatedPlaylists/uploads,"\
+                  "statistics/videoCount)"
+VIDEO_CHANNEL_FIELDS = "etag,items(id,snippet/channelId)"
 
-MAX_VIDEOS = 500
-RELEVANT_DATA = [  'viewCount', 'likeCount', 'dislikeCount', 'commentCount' ]
+# Serializes reads and writes of CHANNELS_IN_PROGRESS when channels
+# are datamined concurrently.
+CHANNELS_LOCK = threading.Lock()
+# channel ids currently being datamined by a worker thread
+CHANNELS_IN_PROGRESS = set()
 
 
 # main functions
 
-def datamine_multiple_channels(CHANNEL_LINKS_TEXT_FILEPATH, 
-                               OUTPUT_PATH, UNFINISHED_PATH):
-    """ For each channel link in the CHANNEL_LINKS_TEXT_FILEPATH create
+def datamine_multiple_channels(config):
+    """ For each channel link in the CHANNEL_LINKS_TEXT_FILEPATH work queue
+    create
     a csv for that channel. Each row of the csv is a video by that channel, 
     columns contain basic information (id, title, date, thumbnail link)
     as well as the data included in RELEVANT_DATA. The rows are ordered from 
     newest to oldest video.
 
     Args:
-        CHANNEL_LINKS_TEXT_FILEPATH (str): filepath to a .txt file where each
-                                           line of the file is a link to a
-                                           youtube channel.
-
-        OUTPUT_PATH (str): the directory path where the finished data 
-                           should be put.
-
-        UNFINISHED_PATH (str): the directory path where the unfinished data
-                               should be put. 
+        config (Config): the settings of the run, see config.py. Its
+                         CHANNEL_LINKS_TEXT_FILEPATH, OUTPUT_PATH,
+                         UNFINISHED_PATH, MAX_WORKERS and WORKER_ID say
+                         where the links and data are and how many
+                         channels to datamine at once.
     Returns:
         None
     Output:
@@ -96,71 +108,256 @@ def datamine_multiple_channels(CHANNEL_LINKS_TEXT_FILEPATH,
     """
 
     print("\ndatamine_multiple_channels is being called")
-    channel_link_list = read_channel_link_file(CHANNEL_LINKS_TEXT_FILEPATH)
-    counter = 0
-    for channel in channel_link_list:
-        counter += 1
-        print(f"\n\n\nchannel link is {channel}, we are on channel {counter} "\
-              f"of {len(channel_link_list)}")
-
-        vid_list, channel_name, channel_id = find_channel_vids(channel) 
+    get_metrics(config.METRICS_LOG_PATH, config.PROMETHEUS_PATH)
+    get_cache(config.CACHE_PATH)
+    quota = get_quota(config.API_KEYS, config.QUOTA_PATH)
+    print(f"\n{quota.total_remaining()} API units left today across "\
+          f"{len(quota.api_keys)} API keys")
+    get_store(config.COMPLETED_LINKS_FILEPATH, config.CHANNEL_STATE_PATH)
+    get_journal(config.JOURNAL_PATH)
+    # the claims of WORKER_ID are only requeued once it is registered
+    with holding_leases(config):
+        work_queue = read_channel_link_file(config)
+        print(f"\n{work_queue.pending_count()} channels in the queue")
+        max_workers = config.MAX_WORKERS
+        if max_workers <= 1:
+            datamine_queued_channels(work_queue, config)
+            return
+
+        print(f"\ndatamining channels {max_workers} at a time")
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            futures = [executor.submit(datamine_queued_channels, work_queue,
+                                       config)
+                       for i in range(max_workers)]
+            for future in as_completed(futures):
+                # re-raise any error from the worker thread
+                future.result()
+
+def datamine_queued_channels(work_queue, config):
+    # Claim and datamine channels until the work queue is empty, the
+    # API keys are out of quota or the API keeps rate limiting. Channels
+    # too large for the quota left today are held and put back in the
+    # queue at the end.
+    over_budget = []
+    try:
+        while True:
+            claimed = work_queue.claim(config.WORKER_ID)
+            if claimed is None:
+                return
+            position, channel = claimed
+            # no count of the channels left, it would scan the whole
+            # queue on every claim
+            print(f"\n\n\nchannel link is {channel}")
+            try:
+                datamine_single_channel(channel, config)
+            except OverBudget as error:
+                print(f"\n{error}, leaving it for another day")
+                over_budget.append(position)
+                continue
+            except ChannelLeased as error:
+                # retried once the other worker's lease would expire
+                print(f"\n{error}, retrying it later")
+                work_queue.release(position, error.lease_expires)
+                continue
+            except (QuotaExhausted, RateLimited) as error:
+                print(f"\n{error}")
+                work_queue.release(position)
+                return
+            except BaseException:
+                work_queue.release(position)
+                raise
+            work_queue.complete(position)
+    finally:
+        for position in over_budget:
+            work_queue.release(position)
+
+def datamine_single_channel(channel, config):
+    # Datamine one channel from its link, safe to run from several threads.
+    vid_list, channel_name, channel_id = find_channel_vids(channel, config)
+    try:
         # vid_list will be None if 
-        # the channel appears in COMPLETED_LINKS_FILEPATH.                                                                
-        if not vid_list:                                                
-            remove_completed_channel(CHANNEL_LINKS_TEXT_FILEPATH)
-            continue 
-
-        for finished_vid_list in datamine_channel(vid_list):
-            print(f"\nlen(vid_list) = {len(vid_list)}")
-            csv_writer(finished_vid_list,channel_name,
-                       UNFINISHED_PATH, channel_id)
+        # the channel was already mined.                                                                
+        if vid_list is None:
+            return
+        if not vid_list:
+            # a channel without uploads has nothing to write
+            print(f"\n{channel} has no uploads")
+            get_store().mark_complete(channel_id)
+            return
+
+        for finished_vid_list in datamine_channel(vid_list, config,
+                                                  channel_id):
+            print(f"\n{channel_name}: {len(finished_vid_list)} videos mined")
+            csv_writer(finished_vid_list, channel_name, channel_id, config)
         print(f"\ndone with {channel}")
-        move_completed_csv(channel_name,OUTPUT_PATH,UNFINISHED_PATH)
-
-
-def find_channel_vids(channel_link, 
+        check_lease(channel_id, config)
+        move_completed_csv(channel_name, config)
+        get_store().mark_complete(channel_id)
+    except LeaseLost as error:
+        print(f"\n{error}")
+        abandon_channel_file(channel_name, config)
+    finally:
+        get_quota().release(channel_id)
+        with CHANNELS_LOCK:
+            CHANNELS_IN_PROGRESS.discard(channel_id)
+
+
+def find_channel_vids(channel_link, config,
                       called_from_finish_data = False):
 
-    playlist_id, channel_id = request_channel_list_response(channel_link)
+    playlist_id, channel_id, video_count = request_channel_list_response(
+                                                              channel_link)
+    get_store(config.COMPLETED_LINKS_FILEPATH).mark_queued(channel_id,
+                                                           playlist_id)
     # Appending to existing data should always be done with
     # finish_data.py , this block prevents duplicate data.
     if not called_from_finish_data:
-        already_mined = prevent_duplicate_data(channel_id,  
-                                               COMPLETED_LINKS_FILEPATH)
+        already_mined = prevent_duplicate_data(channel_id, config)
         if already_mined:
             return None, None, None
+        # only start the channel if it can be finished with the quota left
+        units = estimate_channel_cost(video_count)
+        if not get_quota().reserve(channel_id, units):
+            # workers with other API keys may have the quota for it
+            get_store().release(channel_id, config.WORKER_ID)
+            with CHANNELS_LOCK:
+                CHANNELS_IN_PROGRESS.discard(channel_id)
+            raise OverBudget(f"The {video_count} videos of {channel_id} "\
+                             f"would cost about {units} units, more than "\
+                             "the quota left today")
+        # until get_quota().release(channel_id)
+        charge_to(channel_id)
+
+    # The first page is requested right away to find the channel name,
+    # every other page is requested in the background while the videos
+    # already found are datamined.
+    try:
+        video_items, next_page_token, channel_name = find_all_uploads(
+                                                              playlist_id,
+                                                              '&')
+    except BaseException:
+        if not called_from_finish_data:
+            # nothing was written yet, give the channel back
+            get_quota().release(channel_id)
+            get_store().release(channel_id, config.WORKER_ID)
+            with CHANNELS_LOCK:
+                CHANNELS_IN_PROGRESS.discard(channel_id)
+        raise
+    if not video_items:
+        return [], None, channel_id
+    pages = prefetch_pages(iter_upload_pages(playlist_id, next_page_token,
+                                             len(video_items)),
+                           config.PREFETCH_PAGES)
+    # generator of video objects initialized with basic information.
+    vid_list = chain(parse_playlist_page(video_items, '&'),
+                     chain.from_iterable(pages))
+    return vid_list, channel_name.replace(" ","_"), channel_id
 
-    video_items = [] # list of json data, each index is a video
-    next_page_token = '&' # initiate with a "blank" next page token
+def iter_upload_pages(playlist_id, next_page_token, counter = 0):
+    # Generator of one list of video objects per playlistItems page,
+    # starting at next_page_token.
     while next_page_token:
-        new_video_items, next_page_token, channel_name = find_all_uploads(
+        page_token = next_page_token
+        video_items, next_page_token, channel_name = find_all_uploads(
                                                               playlist_id, 
-                                                              next_page_token)
-        video_items += new_video_items
-        if len(video_items) % 500 == 0:
-            print(f"\n{len(video_items)} videos found... looking for more")
-
-    vid_list = [] # list of video objects initialized with basic information.
-    for item in video_items:
-        vid_id, title, date, thumbnail = json_parse(item,
-                                                    playlist_items = True)
-        vid_list.append(Video(vid_id,title,date,thumbnail))
-    return vid_list, channel_name.replace(" ","_"), channel_id
+                                                              page_token)
+        counter += len(video_items)
+        if counter % 500 == 0:
+            print(f"\n{counter} videos found... looking for more")
+        yield parse_playlist_page(video_items, page_token)
+
+def prefetch_pages(pages, maxsize = 2):
+    # Generator that requests up to 'maxsize' pages ahead of the consumer
+    # from a background thread, so requesting the next page overlaps with
+    # datamining and writing the current one.
+    page_queue = queue.Queue(maxsize = maxsize)
+    stop = threading.Event()
+    done = object()
+    # the pages are charged to the channel of the consumer thread
+    channel_id = charged_channel()
+
+    def put(item):
+        # returns False once the consumer has stopped
+        while not stop.is_set():
+            try:
+                page_queue.put(item, timeout = 0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-def datamine_channel(vid_list):
-    # Generator to take video objects with basic info and make
-    # a 'statistics' request on them.
+    def producer():
+        charge_to(channel_id)
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+            put((done, None))
+        except BaseException as error:
+            put((done, error))
+
+    thread = threading.Thread(target = producer, daemon = True)
+    thread.start()
+    try:
+        while True:
+            page, error = page_queue.get()
+            if page is done:
+                if error is not None:
+                    raise error
+                return
+            yield page
+    finally:
+        # the consumer stopped early, let the producer thread end
+        stop.set()
+
+@contextmanager
+def holding_leases(config):
+    # Register this process as config.WORKER_ID, and renew the leases of
+    # its queue claims and channels from a background thread while the
+    # 'with' block runs. Raises WorkerIdInUse if another live process
+    # runs as config.WORKER_ID.
+    work_queue = get_queue(config.WORK_QUEUE_PATH)
+    work_queue.register(config.WORKER_ID)
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(LEASE_SECONDS / 3):
+            try:
+                get_queue().heartbeat(config.WORKER_ID)
+                get_store().renew_leases(config.WORKER_ID)
+            except Exception as error:
+                # retried at the next beat, well before the lease expires
+                print(f"\ncould not renew the leases: {error}")
+
+    thread = threading.Thread(target = heartbeat, daemon = True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        work_queue.unregister(config.WORKER_ID)
+
+def datamine_channel(vid_list, config, channel_id = None):
+    # Generator to take video objects with basic info, from a list or from
+    # the find_channel_vids generator, and make 'statistics' requests
+    # on them, VIDEOS_PER_REQUEST videos at a time. The batches are
+    # recorded in the run journal under channel_id.
+    vid_iter = iter(vid_list)
     finished_list = []
     counter = 0
-    for vid in vid_list:
-
-        counter += 1
-        if counter%50 == 0:
-            print(f"on video {counter} of {len(vid_list)}")
-        # for each video gather statistics not present in playlist itemlist
-        finished_list.append(datamine_video(vid)) 
-
-        if len(finished_list) > MAX_VIDEOS: # prevent data loss
+    while True:
+        vid_batch = list(islice(vid_iter, VIDEOS_PER_REQUEST))
+        if not vid_batch:
+            break
+        counter += len(vid_batch)
+        print(f"on video {counter}")
+        # gather statistics not present in playlist itemlist
+        finished_list += datamine_video_batch(vid_batch,
+                                              config.RELEVANT_DATA,
+                                              channel_id)
+
+        if len(finished_list) > config.MAX_VIDEOS: # prevent data loss
             print(f"\n{counter} videos mined, writing to csv file")
             yield finished_list
             finished_list = []
@@ -172,17 +369,15 @@ def datamine_channel(vid_list):
 
 def request_channel_list_response(channel_link):
 
-    api_key = get_api_key()
+    # statistics holds the videoCount, for the same quota cost
+    params = {"part": "contentDetails,statistics",
+              "fields": CHANNELS_FIELDS}
     if "user" in channel_link:
-        user_id = channel_link.split("user/",1)[-1]
-        idTag = "forUsername=" + user_id
+        params["forUsername"] = channel_link.split("user/",1)[-1]
     else:
-        channel_id = channel_link.split("channel/",1)[-1]
-        idTag = "id=" + channel_id
-    request_link = ("https://www.googleapis.com/youtube/v3/channels?" \
-                    f"part=contentDetails&{idTag}&key={api_key}")
+        params["id"] = channel_link.split("channel/",1)[-1]
 
-    yt_channel_list_response = requests.get(request_link).json()
+    yt_channel_list_response = api_get("channels", params)
     try:
         playlist_id = yt_channel_list_response['items'] \
                                               [0]['contentDetails'] \
@@ -191,28 +386,28 @@ def request_channel_list_response(channel_link):
         description = "Error getting playlist_id from" \
                       "yt_channel_list_response in function" \
                       "request_channel_list_response" \
-                      f"\nThe API request link used was {request_link}"
-        error_handler(yt_channel_list_response,api_key,description)
+                      f"\nThe API request params used were {params}"
+        error_handler(yt_channel_list_response,get_api_key(),description)
 
     channel_id = yt_channel_list_response['items'][0]['id']
-    return playlist_id, channel_id
+    video_count = int(yt_channel_list_response['items'][0] \
+                      .get('statistics', {}).get('videoCount', 0))
+    return playlist_id, channel_id, video_count
 
+@timed("find_all_uploads")
 def find_all_uploads(playlist_id,next_page_token):
 
-    api_key = get_api_key()
-    request_link = ("https://www.googleapis.com/youtube/v3/" \
-                    f"playlistItems?part=snippet&playlistId={playlist_id}&key"\
-                    f"={api_key}&maxResults=50&pageToken={next_page_token}")
+    params = {"part": "snippet", "playlistId": playlist_id,
+              "maxResults": 50, "fields": PLAYLIST_ITEMS_FIELDS}
+    if next_page_token != '&': # '&' is the "blank" first page token
+        params["pageToken"] = next_page_token
 
-    yt_playlist_itemlist = requests.get(request_link).json()
-    try:
+    yt_playlist_itemlist = api_get("playlistItems", params)
+    # a channel without uploads has no items, nor a name in them
+    channel_name = None
+    if yt_playlist_itemlist.get('items'):
         channel_name = yt_playlist_itemlist['items'][0] \
                                            ["snippet"]['channelTitle'] 
-    except (KeyError, IndexError):
-        description = "Error getting channel name from yt_playlist_itemlist"\
-                      "in function find_all_uploads"\
-                      f"\nThe API request link used was {request_link}"
-        error_handler(yt_playlist_itemlist,api_key,description)
 
     try:
         next_page_token = yt_playlist_itemlist["nextPageToken"]
@@ -220,160 +415,228 @@ def find_all_uploads(playlist_id,next_page_token):
         # No nextPageToken means we have found all the uploads
         next_page_token = None 
 
-    new_video_items = yt_playlist_itemlist['items'] 
+    new_video_items = yt_playlist_itemlist.get('items', [])
     return new_video_items,next_page_token,channel_name
 
-def datamine_video(video_object):
-
-    api_key = get_api_key()
-    vid_id = video_object.get_vid_id()
-    api_link = "https://www.googleapis.com/youtube/v3/videos?"\
-                f"part=statistics&id={vid_id}&key={api_key}"
-    newRequest = requests.get(api_link)
-    if newRequest.status_code == 429:
-        print("status_code 429, too_many_requests")
-        sys.exit()
-    newData = json_parse(newRequest.json()) # RELEVANT_DATA
-    video_object.add_data(newData)
-    return video_object
+@timed("datamine_video_batch")
+def datamine_video_batch(vid_batch, relevant_data, channel_id = None):
+    # Videos a crashed run already mined are taken from the run journal,
+    # the others are requested and recorded in it.
+    journal = get_journal()
+    if journal is None:
+        request_video_batch(vid_batch, relevant_data, channel_id)
+        return vid_batch
+    mined = journal.mined(vid.get_vid_id() for vid in vid_batch)
+    unmined = []
+    for vid in vid_batch:
+        row = mined.get(vid.get_vid_id())
+        if row is None:
+            unmined.append(vid)
+        else:
+            vid.add_data(row[4:])
+    if mined:
+        get_metrics().count("journal_videos_reused", len(mined))
+    if unmined:
+        request_video_batch(unmined, relevant_data, channel_id)
+        journal.record_batch(unmined, channel_id)
+    return vid_batch
+
+def request_video_batch(vid_batch, relevant_data, channel_id = None):
+
+    vid_ids = ",".join(vid.get_vid_id() for vid in vid_batch)
+    params = {"part": "statistics", "id": vid_ids, "maxResults": 50,
+              "fields": statistics_fields(relevant_data)}
+    newRequest = api_get("videos", params)
+    stats_by_id = json_parse(newRequest, relevant_data = relevant_data)
+    missing = []
+    for vid in vid_batch:
+        try:
+            newData = stats_by_id[vid.get_vid_id()]
+        except KeyError:
+            # deleted and private videos are left out of the response
+            print(f"\nNo statistics returned for {vid.get_vid_id()}, "\
+                  "likely because the video is deleted or private"\
+                  "\nRELEVANT_DATA will be set to -1")
+            newData = (-1,) * len(relevant_data)
+            missing.append(vid.get_vid_id())
+        vid.add_data(newData)
+    if missing:
+        get_store().record_tombstones(missing, "no statistics", channel_id)
 
 # Classes
 
 class Video(object):
+    # __slots__ instead of a __dict__ per video, since millions of videos
+    # can be waiting to be written.
+    # page_token is the token of the uploads page the video was found on,
+    # it is not part of the row.
+    __slots__ = ("id", "title", "date", "thumbnail", "data", "page_token")
 
     def __init__(
             self, vid_id,
             title, date,
-            thumbnail):
+            thumbnail, page_token = None):
 
         self.id = vid_id
         self.title = title
         self.date = date
         self.thumbnail = thumbnail
-        self.data = []
+        self.data = ()
+        self.page_token = page_token
 
     def get_vid_id(self):
         return self.id
     def add_data(self,data):
-        self.data += data # RELEVANT_DATA
+        self.data = tuple(data) # RELEVANT_DATA, as ints
 
     def get_data(self):
-        return [self.id, self.title, self.date, self.thumbnail] + self.data
+        return [self.id, self.title, self.date, self.thumbnail, *self.data]
 
 # parsing functions
 
-def json_parse(json_text,playlist_items = False):
-
-    if playlist_items:
-        # the function is being called to parse a playlist items response
-        vid_id = json_text['snippet']['resourceId']['videoId']
-        title = json_text['snippet']['title']
-        date = json_text['snippet']['publishedAt']
-        try:
-            thumbnail = json_text["snippet"]["thumbnails"]["default"]["url"]
-        except KeyError:
-            thumbnail = ""
-        return vid_id, title, date, thumbnail
-
-    # the function is being called to parse a video statistics response
-    data = []
+@timed("parse_playlist_page")
+def parse_playlist_page(video_items, page_token = None):
+    # The Video objects of a page of uploads, in the order of the page.
+    vid_list = []
+    for item in video_items:
+        snippet = item['snippet']
+        thumbnail = snippet.get("thumbnails", {}).get("default", {}) \
+                           .get("url", "")
+        vid_list.append(Video(snippet['resourceId']['videoId'],
+                              snippet['title'], snippet['publishedAt'],
+                              thumbnail, page_token))
+    return vid_list
+
+def statistics_fields(relevant_data):
+    # The fields of a videos statistics response json_parse reads.
+    if not relevant_data:
+        return "etag,items/id"
+    return f"etag,items(id,statistics({','.join(relevant_data)}))"
+
+@timed("json_parse")
+def json_parse(json_text, relevant_data = ()):
+    # {vid_id: counts} of a videos statistics response, which may hold
+    # up to VIDEOS_PER_REQUEST videos. Uploads pages are parsed by
+    # parse_playlist_page. An error body has no items, and says nothing
+    # about which videos still exist.
+    stats_by_id = {}
     try:
-        stats = json_text["items"][0]['statistics']
+        items = json_text["items"]
     except KeyError:
         description = "Error retrieving stats from" \
                       "json_text in function json_parse"
         api_key = get_api_key()
         error_handler(json_text, api_key, description)
-    for dataItem in RELEVANT_DATA:
+        raise ApiError(f"videos request failed: {json_text}")
+    for item in items:
+        stats = item.get('statistics', {})
         try:
-            data.append(stats[dataItem])
+            # counts come as strings, parse them once here
+            data = [int(stats[dataItem]) for dataItem in relevant_data]
         except KeyError:
-            print(f"\nThe request did not retrieve {dataItem}, "\
-                f"likely because {dataItem} was disabled for this video"\
-                f"\n{dataItem} will be set to -1")
-            data.append(-1)
-    return data
+            data = []
+            for dataItem in relevant_data:
+                if dataItem in stats:
+                    data.append(int(stats[dataItem]))
+                    continue
+                print(f"\nThe request did not retrieve {dataItem}, "\
+                    f"likely because {dataItem} was disabled for this video"\
+                    f"\n{dataItem} will be set to -1")
+                data.append(-1)
+        stats_by_id[item['id']] = data
+    return stats_by_id
 
 
 # reading and writing file functions
 
-def csv_writer(vid_list, channel_name,
-               UNFINISHED_PATH, channel_id):
-
-    filename = UNFINISHED_PATH + channel_name + ".csv"
-    try:
-        with open(filename, 'r') as test:
-            file_exists = True
-    except FileNotFoundError:
-        file_exists = False
-    with open(filename, 'a',newline = '') as file:
-        writer = csv.writer(file)
-        if not file_exists:
-            print("creating new csv file") 
-            update_completed_links(channel_id, COMPLETED_LINKS_FILEPATH)
-            remove_completed_channel(CHANNEL_LINKS_TEXT_FILEPATH)
-            header_line = [ "id", "title", "date", "thumbnail"] + RELEVANT_DATA
-            writer.writerow( header_line )
-        print(f"writing to {filename}")
-        for vid in vid_list:
-            vid_data = vid.get_data()
-            writer.writerow(vid_data)
-
-def move_completed_csv(channel_name, OUTPUT_PATH, UNFINISHED_PATH):
-
-    with open(UNFINISHED_PATH + channel_name + ".csv","r") as fin:
-        channels = fin.read().splitlines(True)
-    with open(OUTPUT_PATH + channel_name + ".csv",'w') as fout:
-        fout.writelines(channels)
-    os.remove(UNFINISHED_PATH + channel_name + ".csv")
-
-def read_channel_link_file(filepath):
-
-    with open(filepath, "r") as file:
-        channel_link_list = []
-        channel_link_list += [line.rsplit("\n",1)[0] for line in file]
-    return channel_link_list
-
-def prevent_duplicate_data(channel_id, COMPLETED_LINKS_FILEPATH):
-
-    with open(COMPLETED_LINKS_FILEPATH, 'r') as file:
-        completed_channel_ids = []
-        for line in file:
-            new_id = line.rsplit("/",1)[1]
-            completed_channel_ids.append(new_id.rsplit("\n",1)[0])
-        if channel_id in completed_channel_ids:
+@timed("csv_writer")
+def csv_writer(vid_list, channel_name, channel_id, config):
+
+    check_lease(channel_id, config)
+    output_writer = get_output_writer(config.OUTPUT_FORMAT)
+    filename = config.UNFINISHED_PATH + channel_name + output_writer.extension
+    if not vid_list:
+        # the last batch of datamine_channel can be empty, and would be
+        # a 0-row part in a parquet channel
+        return
+    if not os.path.exists(filename):
+        print(f"creating new {config.OUTPUT_FORMAT} file")
+        update_completed_links(channel_id, channel_name)
+    print(f"writing to {filename}")
+    header_line = [ "id", "title", "date", "thumbnail"] + config.RELEVANT_DATA
+    output_writer.append(filename, header_line, vid_list)
+    get_metrics().count("rows_written", len(vid_list),
+                        output_format = config.OUTPUT_FORMAT)
+    if vid_list:
+        # finish_data resumes paging from the page of the last video
+        get_store().record_flush(channel_id, vid_list[-1].get_vid_id(),
+                                 len(vid_list), vid_list[-1].page_token)
+        journal = get_journal()
+        if journal is not None:
+            journal.clear(vid.get_vid_id() for vid in vid_list)
+
+def move_completed_csv(channel_name, config):
+
+    output_writer = get_output_writer(config.OUTPUT_FORMAT)
+    filename = channel_name + output_writer.extension
+    output_writer.move(config.UNFINISHED_PATH + filename,
+                       config.OUTPUT_PATH + filename)
+
+def abandon_channel_file(channel_name, config):
+    # Move the unfinished file of a channel another worker took over to
+    # 'UNFINISHED_PATH' abandoned/, where finish_data does not look.
+    output_writer = get_output_writer(config.OUTPUT_FORMAT)
+    filename = channel_name + output_writer.extension
+    if os.path.exists(config.UNFINISHED_PATH + filename):
+        abandoned_path = os.path.join(config.UNFINISHED_PATH, "abandoned", "")
+        os.makedirs(abandoned_path, exist_ok = True)
+        output_writer.move(config.UNFINISHED_PATH + filename,
+                           abandoned_path + filename)
+        print(f"\nmoved {filename} to {abandoned_path}")
+
+def read_channel_link_file(config):
+    # Enqueue the links appended to CHANNEL_LINKS_TEXT_FILEPATH since the
+    # last run, and put back the links a crashed run of WORKER_ID left
+    # claimed.
+    work_queue = get_queue(config.WORK_QUEUE_PATH)
+    requeued = work_queue.requeue_claims(config.WORKER_ID)
+    if requeued:
+        print(f"\n{requeued} channels claimed by an earlier run "\
+              "were put back in the queue")
+    work_queue.sync_file(config.CHANNEL_LINKS_TEXT_FILEPATH)
+    return work_queue
+
+def prevent_duplicate_data(channel_id, config):
+
+    store = get_store(config.COMPLETED_LINKS_FILEPATH)
+    with CHANNELS_LOCK:
+        # acquire raises ChannelLeased if another worker holds the channel
+        if channel_id in CHANNELS_IN_PROGRESS or \
+           not store.acquire(channel_id, config.WORKER_ID):
             print("\n\nThis channel has already been partially" \
                 f" or fully mined.\nThe channel id: {channel_id} appears in" \
-                f" {COMPLETED_LINKS_FILEPATH}.\nIf the channel link in"   \
-                f" {CHANNEL_LINKS_TEXT_FILEPATH} was given as a\n/user/ link"\
+                f" {store.path}.\nIf the channel link in"   \
+                f" {config.CHANNEL_LINKS_TEXT_FILEPATH} was given as a\n/user/ link"\
                 f", the channel id: {channel_id} was found through an API request.")
             return True
+        # claim the channel so no other worker thread datamines it
+        CHANNELS_IN_PROGRESS.add(channel_id)
         return False
 
-def update_completed_links(channel_id, COMPLETED_LINKS_FILEPATH):
+def check_lease(channel_id, config):
+    # Raise LeaseLost once another worker took the channel over.
+    if not get_store().owns(channel_id, config.WORKER_ID):
+        raise LeaseLost(channel_id)
+
+def update_completed_links(channel_id, channel_name):
     
-    with open(COMPLETED_LINKS_FILEPATH, "a") as file:
-        file.write("https://www.youtube.com/channel/"+ channel_id + "\n")
+    get_store().mark_in_progress(channel_id, channel_name)
             
-def remove_completed_channel(CHANNEL_LINKS_TEXT_FILEPATH):
-
-    with open(CHANNEL_LINKS_TEXT_FILEPATH,"r") as fin:
-        channels = fin.read().splitlines(True)
-    with open(CHANNEL_LINKS_TEXT_FILEPATH,'w') as fout:
-        if len(channels) > 1:
-            fout.writelines(channels[1:])
-        else:
-            fout.writelines([""])
-
 def get_api_key():
-
-    with open(API_KEY_PATH,'r') as file:
-        api_key_raw = file.readline()
-        if "\n" in api_key_raw:
-            api_key = api_key_raw.replace("\n","")
-        else:
-            api_key = api_key_raw
-        return api_key
+    # The key the next API request will use, the keys were read
+    # once with the config. A lookup in the quota database, so only
+    # called to report an error.
+    return get_quota().key_for()
 
 # other functions
 
@@ -387,7 +650,8 @@ def error_handler(json_text, api_key, description):
 
 if __name__ == "__main__":
 
-    api_key = get_api_key()
-    datamine_multiple_channels(
-        CHANNEL_LINKS_TEXT_FILEPATH,
-        OUTPUT_PATH, UNFINISHED_PATH)
\ No newline at end of file
+    config = load_config(description = "Write a csv file for each "
+                                       "YouTube channel in a text file.")
+    datamine_multiple_channels(config)
+    print_cache_stats()
+    get_metrics().flush()
\ No newline at end of file
@@ -0,0 +1,381 @@
+"""Indexed store of the state of every channel the scraper has seen.
+
+channel_scraper used to decide whether a channel had already been
+data-mined by reading all of 'COMPLETED_LINKS_FILEPATH' for every channel.
+This module keeps that information in a SQLite table indexed by channel
+ID instead, so checking a channel costs one index lookup however many
+channels have been mined, and any number of threads or processes can
+update it at once.
+
+For each channel the store records:
+    status: 'queued' once its uploads playlist has been looked up,
+            'in-progress' once its first rows were written to a csv file
+            in 'UNFINISHED_PATH' and 'complete' once its file was moved to
+            'OUTPUT_PATH'.
+    channel_name, playlist_id,
+    last_vid_id: the last video written to the channel's csv file,
+    page_token: the token of the uploads page last_vid_id was found on,
+                ('&' for the first page), so finish_data can resume
+                paging there instead of from the first page,
+    row_count: the number of rows written to the channel's csv file,
+    owner, lease_expires: the worker (its 'WORKER_ID') datamining the
+                channel, and until when it holds the channel unless it
+                renews its lease (renew_leases).
+
+The store also keeps the tombstones of videos found to be deleted or
+private, with the channel they belonged to when it is known, so lookups
+skip them instead of asking the API about them again.
+
+update_data finds the channel of a file in 'OUTPUT_PATH' by its name
+(find_by_name), so it only asks the API about channels it has never seen.
+
+Workers on several machines can share the store, like the work queue
+(see work_queue.py). A worker only starts a channel it acquired: one no
+other worker holds a live lease on. The lease lasts CHANNEL_LEASE_SECONDS,
+long enough for the owner to finish the channel on its next run, and a
+channel whose owner stopped renewing it is taken over and mined again
+from the start. The old owner then finds it lost the channel (owns) and
+drops its unfinished file, so no row is written twice. A worker that
+acquires a channel but does not start it, e.g. for lack of quota, gives
+its lease up right away (release).
+
+The first time the store is opened, every channel listed in the old
+'COMPLETED_LINKS_FILEPATH' text file is imported as 'in-progress', since
+that file did not say whether a channel was finished.
+
+Attributes:
+    CHANNEL_STATE_PATH (str):
+        The filepath of the SQLite database.
+
+    CHANNEL_LEASE_SECONDS (float):
+        The number of seconds a worker holds a channel without renewing
+        its lease.
+"""
+
+
+import os
+import sqlite3
+import threading
+import time
+
+# variables
+CHANNEL_STATE_PATH = "channel_links/channel_state.sqlite"
+CHANNEL_LEASE_SECONDS = 2 * 24 * 60 * 60
+
+QUEUED = "queued"
+IN_PROGRESS = "in-progress"
+COMPLETE = "complete"
+
+STORE = None
+STORE_LOCK = threading.Lock()
+
+
+class ChannelLeased(Exception):
+    # Another worker holds the channel until the unix time lease_expires.
+    def __init__(self, channel_id, lease_expires):
+        super().__init__(f"{channel_id} is leased by another worker")
+        self.channel_id = channel_id
+        self.lease_expires = lease_expires
+
+
+class LeaseLost(Exception):
+    # Another worker took the channel over.
+    def __init__(self, channel_id):
+        super().__init__(f"{channel_id} was taken over by another worker")
+        self.channel_id = channel_id
+
+
+class ChannelStateStore(object):
+
+    def __init__(self, path):
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.path = path
+        self.lock = threading.Lock()
+        # several processes may share the database, wait for their
+        # transactions instead of failing
+        self.connection = sqlite3.connect(path, timeout = 60,
+                                          check_same_thread = False,
+                                          isolation_level = None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS channels ("
+            " channel_id TEXT PRIMARY KEY,"
+            " channel_name TEXT,"
+            " status TEXT NOT NULL,"
+            " playlist_id TEXT,"
+            " last_vid_id TEXT,"
+            " row_count INTEGER NOT NULL DEFAULT 0,"
+            " updated_at REAL NOT NULL,"
+            " page_token TEXT,"
+            " owner TEXT,"
+            " lease_expires REAL)")
+        for column in ("page_token TEXT", "owner TEXT", "lease_expires REAL"):
+            self.add_column(column)
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS channels_status"
+            " ON channels (status)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS channels_name"
+            " ON channels (channel_name)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tombstones ("
+            " vid_id TEXT PRIMARY KEY,"
+            " channel_id TEXT,"
+            " reason TEXT NOT NULL,"
+            " recorded_at REAL NOT NULL)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta ("
+            " name TEXT PRIMARY KEY, value TEXT)")
+
+    def add_column(self, column):
+        # Add a column to a channels table made by an older version.
+        name = column.split()[0]
+        columns = [row[1] for row in self.connection.execute(
+                                         "PRAGMA table_info(channels)")]
+        if name in columns:
+            return
+        try:
+            self.connection.execute(f"ALTER TABLE channels ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            # another process added it first
+            pass
+
+    def transaction(self):
+        # 'BEGIN IMMEDIATE' takes the write lock up front, so a read
+        # followed by a write cannot interleave with another process.
+        return Transaction(self)
+
+    def get(self, channel_id):
+        # The state of a channel as a dict, or None for a new channel.
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT * FROM channels WHERE channel_id = ?", (channel_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            columns = [description[0] for description in cursor.description]
+            return dict(zip(columns, row))
+
+    def find_by_name(self, channel_name):
+        # The state of the channel whose files are named channel_name, or
+        # None if no channel, or more than one, has that name.
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT * FROM channels WHERE channel_name = ? LIMIT 2",
+                (channel_name,))
+            rows = cursor.fetchall()
+            if len(rows) != 1:
+                return None
+            columns = [description[0] for description in cursor.description]
+            return dict(zip(columns, rows[0]))
+
+    def acquire(self, channel_id, worker_id):
+        # Take the lease of a channel worker_id is about to datamine from
+        # the start. Returns False if it is already mined, or partially
+        # mined by worker_id or an older version, which finish_data
+        # finishes. Raises ChannelLeased if another worker holds it.
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT status, owner, lease_expires FROM channels"
+                " WHERE channel_id = ?", (channel_id,)).fetchone()
+            status, owner, lease_expires = row or (QUEUED, None, None)
+            if status == COMPLETE:
+                return False
+            if owner not in (None, worker_id) and lease_expires > now:
+                raise ChannelLeased(channel_id, lease_expires)
+            if status == IN_PROGRESS and owner in (None, worker_id):
+                return False
+            if status == IN_PROGRESS:
+                print(f"\n{channel_id}: the lease of {owner} expired, "\
+                      "taking the channel over")
+            # a channel taken over is mined again from the start
+            connection.execute(
+                "INSERT INTO channels (channel_id, status, updated_at,"
+                " owner, lease_expires) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (channel_id) DO UPDATE SET"
+                " status = excluded.status, owner = excluded.owner,"
+                " lease_expires = excluded.lease_expires,"
+                " last_vid_id = NULL, page_token = NULL, row_count = 0",
+                (channel_id, QUEUED, now, worker_id,
+                 now + CHANNEL_LEASE_SECONDS))
+            return True
+
+    def lease(self, channel_id, worker_id):
+        # Take or renew the lease of a channel worker_id has partially
+        # mined. Returns False if another worker took it over.
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT owner FROM channels WHERE channel_id = ?",
+                (channel_id,)).fetchone()
+            if row is not None and row[0] not in (None, worker_id):
+                return False
+            connection.execute(
+                "UPDATE channels SET owner = ?, lease_expires = ?"
+                " WHERE channel_id = ?",
+                (worker_id, now + CHANNEL_LEASE_SECONDS, channel_id))
+            return True
+
+    def owns(self, channel_id, worker_id):
+        # False once another worker took the channel over.
+        state = self.get(channel_id)
+        return state is None or state["owner"] in (None, worker_id)
+
+    def renew_leases(self, worker_id):
+        # Renew the lease of every channel worker_id has not finished.
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE channels SET lease_expires = ?"
+                " WHERE owner = ? AND status != ?",
+                (time.time() + CHANNEL_LEASE_SECONDS, worker_id, COMPLETE))
+
+    def release(self, channel_id, worker_id):
+        # Give up the lease of a channel worker_id acquired but did not
+        # start, so other workers can take it right away.
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE channels SET owner = NULL, lease_expires = NULL"
+                " WHERE channel_id = ? AND owner = ? AND status = ?",
+                (channel_id, worker_id, QUEUED))
+
+    def mark_queued(self, channel_id, playlist_id):
+        # Record a channel whose uploads playlist was looked up, unless
+        # the channel is already known.
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO channels (channel_id, status, playlist_id,"
+                " updated_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (channel_id) DO UPDATE SET"
+                " playlist_id = excluded.playlist_id",
+                (channel_id, QUEUED, playlist_id, time.time()))
+
+    def mark_in_progress(self, channel_id, channel_name):
+
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO channels (channel_id, channel_name, status,"
+                " updated_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (channel_id) DO UPDATE SET"
+                " channel_name = excluded.channel_name,"
+                " status = excluded.status,"
+                " updated_at = excluded.updated_at",
+                (channel_id, channel_name, IN_PROGRESS, time.time()))
+
+    def record_channel_name(self, channel_id, channel_name):
+        # Record the name of a channel found from its file in
+        # 'OUTPUT_PATH', which is complete if the channel is new.
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO channels (channel_id, channel_name, status,"
+                " updated_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (channel_id) DO UPDATE SET"
+                " channel_name = excluded.channel_name",
+                (channel_id, channel_name, COMPLETE, time.time()))
+
+    def record_flush(self, channel_id, last_vid_id, rows_written,
+                     page_token = None):
+        # Called every time rows of a channel are written to its csv file.
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE channels SET last_vid_id = ?,"
+                " row_count = row_count + ?, updated_at = ?,"
+                " page_token = ? WHERE channel_id = ?",
+                (last_vid_id, rows_written, time.time(), page_token,
+                 channel_id))
+
+    def mark_complete(self, channel_id):
+
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE channels SET status = ?, updated_at = ?"
+                " WHERE channel_id = ?",
+                (COMPLETE, time.time(), channel_id))
+
+    def record_tombstones(self, vid_ids, reason, channel_id = None):
+        # Record videos the API no longer returns, e.g. deleted or
+        # private ones.
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT INTO tombstones VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (vid_id) DO UPDATE SET"
+                " channel_id = COALESCE(excluded.channel_id, channel_id),"
+                " reason = excluded.reason",
+                [(vid_id, channel_id, reason, now) for vid_id in vid_ids])
+
+    def tombstoned(self, vid_ids):
+        # The videos of vid_ids known to be deleted or private.
+        vid_ids = list(vid_ids)
+        found = set()
+        with self.lock:
+            for i in range(0, len(vid_ids), 500):
+                batch = vid_ids[i:i + 500]
+                marks = ", ".join("?" for vid_id in batch)
+                found.update(row[0] for row in self.connection.execute(
+                    f"SELECT vid_id FROM tombstones WHERE vid_id IN ({marks})",
+                    batch))
+        return found
+
+    def import_completed_links(self, filepath):
+        # Import the channel ids of an old completed links text file,
+        # only the first time the store is opened.
+        with self.transaction() as connection:
+            imported = connection.execute(
+                "SELECT value FROM meta WHERE name = 'completed_links'"
+                ).fetchone()
+            if imported is not None or not os.path.exists(filepath):
+                return
+            now = time.time()
+            with open(filepath, "r") as file:
+                for line in file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    channel_id = line.rsplit("/",1)[-1]
+                    connection.execute(
+                        "INSERT OR IGNORE INTO channels (channel_id, status,"
+                        " updated_at) VALUES (?, ?, ?)",
+                        (channel_id, IN_PROGRESS, now))
+            connection.execute(
+                "INSERT INTO meta VALUES ('completed_links', ?)", (filepath,))
+
+
+class Transaction(object):
+
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store.lock.acquire()
+        try:
+            self.store.connection.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.store.lock.release()
+            raise
+        return self.store.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.store.connection.execute("COMMIT")
+            else:
+                self.store.connection.execute("ROLLBACK")
+        finally:
+            self.store.lock.release()
+
+
+def get_store(completed_links_filepath = None, path = None):
+    # The store shared by every thread, at path, or CHANNEL_STATE_PATH.
+    # The old completed links file is imported when the store is first
+    # opened.
+    global STORE
+    with STORE_LOCK:
+        if STORE is None:
+            STORE = ChannelStateStore(path or CHANNEL_STATE_PATH)
+            if completed_links_filepath:
+                STORE.import_completed_links(completed_links_filepath)
+        return STORE
@@ -0,0 +1,139 @@
+"""One command line entry point for every part of the module.
+
+    python cli.py scrape   [options]    channel_scraper.py
+    python cli.py finish   [options]    finish_data.py
+    python cli.py update   [options]    update_data.py
+    python cli.py refresh  [options]    refresh_stats.py
+    python cli.py build    [options]    build_dataset.py
+    python cli.py resume   [options]    rerun what a crash interrupted
+
+The options are the settings of config.py, e.g. --max-videos 1000, and
+'python cli.py <command> --help' lists them. Only the module of the
+command is imported, when the command runs, so 'python cli.py --help'
+or a bad option returns without loading requests or pyarrow.
+
+Every command is recorded in the run journal (see run_journal.py) when
+it starts and when it returns. 'resume' reruns the last command that
+never returned, with its options: scrape after finishing the files it
+left unfinished, the others as they were. The videos the crashed run
+mined are taken from the journal instead of being requested again.
+Once the rerun returns, every interrupted run of that command with
+those options is finished. Other interrupted commands are left for the
+next 'resume'.
+
+Attributes:
+    COMMANDS (dict):
+        command: (module, function, description). The function is called
+        with the Config of the run.
+"""
+
+
+import importlib
+import sys
+
+from config import load_config
+from metrics import get_metrics
+from quota import get_quota
+from response_cache import print_cache_stats
+from run_journal import get_journal
+
+# variables
+COMMANDS = {
+    "scrape": ("channel_scraper", "datamine_multiple_channels",
+               "Write a file for each YouTube channel in a text file."),
+    "finish": ("finish_data", "finish_data",
+               "Finish data-mining any channels with files in "
+               "UNFINISHED_PATH."),
+    "update": ("update_data", "update_all_data",
+               "Update all files in OUTPUT_PATH with new videos."),
+    "refresh": ("refresh_stats", "refresh_all_stats",
+                "Snapshot the counts of the videos in OUTPUT_PATH as "
+                "time series."),
+    "build": ("build_dataset", "build_dataset",
+              "Build one partitioned dataset out of the channel files in "
+              "OUTPUT_PATH."),
+}
+
+USAGE = "usage: python cli.py {" + ",".join(list(COMMANDS) + ["resume"]) \
+        + "} [options]"
+
+
+def main(argv = None):
+    """Run the command named by the first argument.
+
+    Args:
+        argv (list of str): the command and its options, by default
+                            sys.argv[1:].
+    Returns:
+        int: the exit status.
+    """
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] in ("-h", "--help"):
+        print(USAGE)
+        for command, (module, function, description) in COMMANDS.items():
+            print(f"  {command:8} {description}")
+        print(f"  {'resume':8} Rerun the last command a crash interrupted.")
+        return 0 if argv else 2
+    command, options = argv[0], argv[1:]
+    if command == "resume":
+        return resume(options)
+    if command not in COMMANDS:
+        print(f"{USAGE}\nunknown command {command!r}")
+        return 2
+    run_command(command, options)
+    return 0
+
+def run_command(command, options, record = True):
+    # Load the settings, import the module of the command and run it,
+    # recording the run in the run journal unless record is False.
+    module_name, function_name, description = COMMANDS[command]
+    config = load_config(options, description = description)
+    journal = get_journal(config.JOURNAL_PATH)
+    if not record:
+        journal = None
+    run_id = None
+    if journal is not None:
+        run_id = journal.start_run(command, options)
+    function = getattr(importlib.import_module(module_name), function_name)
+    get_quota(config.API_KEYS, config.QUOTA_PATH)
+    function(config)
+    print_cache_stats()
+    get_metrics().flush()
+    if journal is not None:
+        journal.finish_run(run_id)
+
+def resume(options):
+    # Rerun the last interrupted command, and mark its interrupted runs
+    # finished once it returns.
+    config = load_config(options, description = "Rerun the last command "
+                                                "a crash interrupted.")
+    journal = get_journal(config.JOURNAL_PATH)
+    if journal is None:
+        print("\nthe run journal is turned off, nothing to resume")
+        return 1
+    runs = journal.interrupted_runs()
+    if not runs:
+        print("\nno interrupted run to resume")
+        return 0
+    run_id, command, options = runs[-1]
+    print(f"\nresuming {command} {' '.join(options)}".rstrip())
+    if command == "scrape":
+        # part of the scrape resumed, a crash in it leaves the scrape
+        # as the run to resume
+        run_command("finish", options, record = False)
+    run_command(command, options)
+    left = 0
+    for interrupted_id, interrupted_command, interrupted_options in runs:
+        if (interrupted_command, interrupted_options) == (command, options):
+            journal.finish_run(interrupted_id)
+        else:
+            left += 1
+    if left:
+        print(f"\n{left} other interrupted runs left to resume")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""Configuration of a channel_scraper, finish_data, update_data,
+refresh_stats or build_dataset run, or of a cli.py command.
+
+The settings of a run are loaded once, when the script starts, into a
+Config object which is passed to every function that needs one. The API
+keys are read from 'API_KEY_PATH' at the same time, so no function opens
+the key file again while the run is going.
+
+Every setting has a default (the class attributes of Config), which can
+be overridden by an environment variable named after it with a
+'YT_SCRAPER_' prefix, e.g. YT_SCRAPER_MAX_VIDEOS=1000, and then by a
+command line option, e.g. --max-videos 1000. Lists, like RELEVANT_DATA
+or YT_SCRAPER_API_KEYS, are given comma separated.
+
+Attributes of Config:
+    API_KEY_PATH (str):
+        The filepath for a .txt file where each line is an API key.
+        Requests use the first key with quota left (see quota.py).
+
+    API_KEYS (list of str):
+        The API keys. Read from API_KEY_PATH unless they are given.
+
+    CHANNEL_LINKS_TEXT_FILEPATH (str):
+        The filepath for a .txt file where each line is a link to
+        a YouTube channel. The file is read as an append-only journal
+        into the work queue of work_queue.py and is never rewritten.
+
+    OUTPUT_PATH (str):
+        The directory where the completed data should go.
+
+    UNFINISHED_PATH (str):
+        The directory where the incomplete data should go.
+
+    COMPLETED_LINKS_FILEPATH (str):
+        The filepath to a .txt file which contains the links
+        to channels which have been partially or fully data-mined
+        by older versions of the module. Its channels are imported
+        once into the channel state store of channel_state.py, which
+        now prevents duplicate data.
+
+    OUTPUT_FORMAT (str):
+        The format the data is written in, "csv" or "parquet"
+        (see output_writers.py). Parquet needs the pyarrow module.
+        An unfinished channel must be finished with the format it
+        was started with.
+
+    MAX_VIDEOS (int):
+        The number of videos the module should datamine at a time before
+        writing the data to a csv file. It should be noted that the module
+        will always write the csv file when it completes a channel.
+
+    PREFETCH_PAGES (int):
+        The number of playlistItems pages the module may request ahead
+        of the videos it is datamining. Videos are datamined and written
+        as their pages arrive, so memory use is bounded by about
+        MAX_VIDEOS plus PREFETCH_PAGES pages, whatever the channel size.
+
+    MAX_WORKERS (int):
+        The number of channels datamine_multiple_channels should datamine
+        at once. Each channel still gets its own csv file. With 1 the
+        channels are datamined one after another.
+
+    WORKER_ID (str):
+        The name a run claims channels from the work queue under. Runs
+        sharing a work queue at the same time need different names,
+        and a run started under the name of a live run is refused
+        (WorkerIdInUse). By default the hostname.
+
+    WORK_QUEUE_PATH (str):
+        The filepath of the work queue database (see work_queue.py).
+
+    CHANNEL_STATE_PATH (str):
+        The filepath of the channel state database (see channel_state.py).
+        Runs on several machines shard the channels between them by
+        sharing both databases, each with its own WORKER_ID and
+        UNFINISHED_PATH.
+
+    JOURNAL_PATH (str):
+        The filepath of the run journal database (see run_journal.py),
+        which keeps the videos mined but not written yet, so a crashed
+        run is resumed without requesting them again. Runs sharing the
+        work queue each need their own. An empty path turns it off.
+
+    QUOTA_PATH (str):
+        The filepath of the database the API units spent are counted
+        in (see quota.py). Runs sharing API keys should share it.
+
+    CACHE_PATH (str):
+        The filepath of the database API responses are cached in (see
+        response_cache.py). An empty path turns the cache off.
+
+    METRICS_LOG_PATH (str):
+        The filepath the metrics of the run are appended to as json
+        lines (see metrics.py). An empty path turns the log off.
+
+    PROMETHEUS_PATH (str):
+        The filepath the metrics are also written to in the Prometheus
+        text format, e.g. for the textfile collector of node_exporter.
+        By default they are not.
+
+    RELEVANT_DATA (list of str):
+        The data that json_parse() should look for. Metrics can be removed
+        if they are not deemed relevant to write to the csv file. Removing a
+        metric will not save API quota cost.
+
+    STATS_PATH (str):
+        The filepath of the SQLite database refresh_stats.py keeps the
+        snapshots of the counts of every video in.
+
+    REFRESH_MAX_UNITS (int):
+        The most API units a run of refresh_stats.py may spend, by
+        default every unit left today.
+
+    DATASET_PATH (str):
+        The directory build_dataset.py writes the partitions of the
+        combined dataset and its video id index to.
+"""
+
+
+import argparse
+import os
+
+from channel_state import CHANNEL_STATE_PATH
+from metrics import METRICS_LOG_PATH, PROMETHEUS_PATH
+from quota import QUOTA_PATH, read_api_keys
+from response_cache import CACHE_PATH
+from run_journal import JOURNAL_PATH
+from work_queue import WORK_QUEUE_PATH, default_worker_id
+
+ENV_PREFIX = "YT_SCRAPER_"
+
+
+class Config(object):
+
+    API_KEY_PATH = "api_key.txt"
+    API_KEYS = None
+    CHANNEL_LINKS_TEXT_FILEPATH = "channel_links/channel_links.txt"
+    OUTPUT_PATH = "data/"
+    UNFINISHED_PATH = "data/unfinished/"
+    COMPLETED_LINKS_FILEPATH = "channel_links/completed_channel_links.txt"
+
+    OUTPUT_FORMAT = "csv"
+    MAX_VIDEOS = 500
+    PREFETCH_PAGES = 2
+    MAX_WORKERS = 1
+    WORKER_ID = None
+    WORK_QUEUE_PATH = WORK_QUEUE_PATH
+    CHANNEL_STATE_PATH = CHANNEL_STATE_PATH
+    JOURNAL_PATH = JOURNAL_PATH
+    QUOTA_PATH = QUOTA_PATH
+    CACHE_PATH = CACHE_PATH
+    METRICS_LOG_PATH = METRICS_LOG_PATH
+    PROMETHEUS_PATH = PROMETHEUS_PATH
+    RELEVANT_DATA = [ 'viewCount', 'likeCount', 'dislikeCount',
+                      'commentCount' ]
+    STATS_PATH = "data/video_stats.sqlite"
+    REFRESH_MAX_UNITS = None
+    DATASET_PATH = "dataset/"
+
+    def __init__(self, **settings):
+
+        for name, value in settings.items():
+            if not hasattr(Config, name):
+                raise TypeError(f"Unknown setting {name}")
+            setattr(self, name, value)
+        if self.API_KEYS is None:
+            self.API_KEYS = read_api_keys(self.API_KEY_PATH)
+        if self.WORKER_ID is None:
+            self.WORKER_ID = default_worker_id()
+
+    def __repr__(self):
+        # the API keys are left out
+        settings = ", ".join(f"{name}={getattr(self, name)!r}"
+                             for name in SETTINGS if name != "API_KEYS")
+        return f"Config({settings})"
+
+
+# the settings and how to parse them from a string
+SETTINGS = {
+    "API_KEY_PATH": str,
+    "API_KEYS": lambda value: [key.strip() for key in value.split(",")
+                               if key.strip()],
+    "CHANNEL_LINKS_TEXT_FILEPATH": str,
+    "OUTPUT_PATH": str,
+    "UNFINISHED_PATH": str,
+    "COMPLETED_LINKS_FILEPATH": str,
+    "OUTPUT_FORMAT": str,
+    "MAX_VIDEOS": int,
+    "PREFETCH_PAGES": int,
+    "MAX_WORKERS": int,
+    "WORKER_ID": str,
+    "WORK_QUEUE_PATH": str,
+    "CHANNEL_STATE_PATH": str,
+    "JOURNAL_PATH": str,
+    "QUOTA_PATH": str,
+    "CACHE_PATH": str,
+    "METRICS_LOG_PATH": str,
+    "PROMETHEUS_PATH": str,
+    "RELEVANT_DATA": lambda value: [name.strip() for name in value.split(",")
+                                    if name.strip()],
+    "STATS_PATH": str,
+    "REFRESH_MAX_UNITS": int,
+    "DATASET_PATH": str,
+}
+
+
+def load_config(argv = None, environ = None, description = None):
+    """Load the settings of a run from the environment and the command line.
+
+    Args:
+        argv (list of str): the command line options, by default
+                            sys.argv[1:].
+
+        environ (dict): the environment variables, by default os.environ.
+
+        description (str): the description shown by --help.
+    Returns:
+        Config: the settings, with the API keys read.
+    """
+
+    if environ is None:
+        environ = os.environ
+    settings = {}
+    for name, parse in SETTINGS.items():
+        if ENV_PREFIX + name in environ:
+            settings[name] = parse(environ[ENV_PREFIX + name])
+
+    parser = argparse.ArgumentParser(description = description)
+    for name, parse in SETTINGS.items():
+        parser.add_argument("--" + name.lower().replace("_", "-"),
+                            dest = name, type = parse, default = None,
+                            help = f"default {getattr(Config, name)!r}")
+    arguments = parser.parse_args(argv)
+    for name in SETTINGS:
+        if getattr(arguments, name) is not None:
+            settings[name] = getattr(arguments, name)
+    return Config(**settings)
@@ -0,0 +1,152 @@
+"""Delta segments holding the newest rows of a finished channel file.
+
+update_data used to add new uploads to a channel by rewriting the whole
+csv file with the new rows on top. Instead, every update pass of a
+channel now writes its new rows to a small segment file next to it:
+
+    data/Dude_Perfect.csv                      the base file
+    data/deltas/Dude_Perfect/000001.csv        rows of the first update
+    data/deltas/Dude_Perfect/000002.csv        rows of the second update
+
+so an update costs O(new rows). Every segment is written in the output
+format of its base file (see output_writers.py), with the same columns,
+ordered from newest to oldest video. Reading the
+segments from the highest number down and then the base file (iter_rows)
+gives every video of the channel from newest to oldest.
+
+A segment is written under a temporary name and only renamed into place
+once the update pass of its channel is complete, so a crash never leaves
+a segment with a gap in it. Once the segments of a channel pass
+COMPACT_RATIO of the size of its base file, or there are more than
+MAX_SEGMENTS of them, compact merges them into the base file. That keeps
+the cost of the occasional full rewrite proportional to the rows added.
+
+Attributes:
+    DELTA_DIRNAME (str):
+        The name of the directory, next to the base files, the segments
+        are kept in.
+
+    COMPACT_RATIO (float):
+        Compact a channel once its segments are this large
+        compared to its base file.
+
+    MAX_SEGMENTS (int):
+        Compact a channel once it has more segments than this.
+"""
+
+
+import os
+import shutil
+
+from output_writers import get_output_writer_for
+
+# variables
+DELTA_DIRNAME = "deltas"
+COMPACT_RATIO = 0.25
+MAX_SEGMENTS = 32
+
+TEMP_SUFFIX = ".tmp"
+MERGED_SUFFIX = ".merged"
+
+
+def segment_dir(filepath):
+    # data/Dude_Perfect.csv -> data/deltas/Dude_Perfect
+    directory, filename = os.path.split(filepath)
+    return os.path.join(directory, DELTA_DIRNAME, filename.rsplit(".",1)[0])
+
+def list_segments(filepath):
+    # The committed segments of a base file, from oldest to newest.
+    directory = segment_dir(filepath)
+    if not os.path.isdir(directory):
+        return []
+    extension = get_output_writer_for(filepath).extension
+    return [os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if name.endswith(extension)]
+
+def new_segment_path(filepath):
+    # The temporary path to write the next segment to. Pass it to
+    # commit_segment once every row of the update is written.
+    directory = segment_dir(filepath)
+    os.makedirs(directory, exist_ok = True)
+    segments = list_segments(filepath)
+    number = 1
+    if segments:
+        number = int(os.path.basename(segments[-1]).split(".",1)[0]) + 1
+    extension = get_output_writer_for(filepath).extension
+    return os.path.join(directory, f"{number:06d}{extension}{TEMP_SUFFIX}")
+
+def commit_segment(temp_path):
+
+    if os.path.exists(temp_path):
+        os.replace(temp_path, temp_path[:-len(TEMP_SUFFIX)])
+
+def discard_uncommitted_segments(filepath):
+    # Remove segments an interrupted update left behind, and finish an
+    # interrupted compaction.
+    recover_compaction(filepath)
+    directory = segment_dir(filepath)
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith(TEMP_SUFFIX):
+            remove_path(os.path.join(directory, name))
+
+def iter_rows(filepath):
+    # Generator of every row of a channel, segments first, from newest
+    # to oldest video. Headers are skipped.
+    output_writer = get_output_writer_for(filepath)
+    for path in list_segments(filepath)[::-1] + [filepath]:
+        yield from output_writer.iter_rows(path)
+
+def needs_compaction(filepath):
+
+    segments = list_segments(filepath)
+    if len(segments) > MAX_SEGMENTS:
+        return True
+    output_writer = get_output_writer_for(filepath)
+    delta_bytes = sum(output_writer.size(path) for path in segments)
+    return delta_bytes > COMPACT_RATIO * output_writer.size(filepath)
+
+def compact(filepath):
+    # Merge the segments of a channel into its base file. The segment
+    # directory is renamed out of the way before the new base file is
+    # moved into place, so a crash part way through can be finished by
+    # recover_compaction without losing or duplicating rows.
+    segments = list_segments(filepath)
+    if not segments:
+        return
+    temp_filepath = compaction_temp_path(filepath)
+    remove_path(temp_filepath)
+    get_output_writer_for(filepath).merge(segments[::-1] + [filepath],
+                                          temp_filepath)
+    os.replace(segment_dir(filepath), segment_dir(filepath) + MERGED_SUFFIX)
+    recover_compaction(filepath)
+
+def recover_compaction(filepath):
+    # Finish a compaction of filepath that was interrupted.
+    merged_dir = segment_dir(filepath) + MERGED_SUFFIX
+    if not os.path.isdir(merged_dir):
+        return
+    temp_filepath = compaction_temp_path(filepath)
+    if os.path.exists(temp_filepath):
+        get_output_writer_for(filepath).replace(temp_filepath, filepath)
+    shutil.rmtree(merged_dir)
+
+def compaction_temp_path(filepath):
+    # does not end with the extension, so it is never mistaken for a channel
+    return filepath + TEMP_SUFFIX
+
+def remove_path(path):
+    # channels are files in some output formats and directories in others
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def compact_if_needed(filepath):
+
+    if needs_compaction(filepath):
+        print(f"\ncompacting {len(list_segments(filepath))} "\
+              f"delta segments into {filepath}")
+        compact(filepath)
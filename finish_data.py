@@ -6,27 +6,69 @@ Then add any videos to the csv file that are older than the oldest video. Since
 the data is organized chronologically, this will be the last row. Once the channel has
 been completed, move the csv file to the 'OUTPUT_PATH' directory.
 
+Every time channel_scraper writes rows of a channel, the token of the
+uploads page its last video was on is recorded in the channel state store
+(see channel_state.py). Paging resumes from that page, so finishing a
+channel only requests the pages it has left. The whole uploads playlist is
+only scanned for the last video when no page was recorded, or the last
+video is no longer near it.
+
+The last video of a file may have been deleted or made private since it
+was written. Its channel is then found from the channel state store, or
+from another video of the file, and paging resumes at the first upload
+published before the last row's date instead, so the channel is neither
+scanned for nothing nor left unfinished. Videos the API no longer returns
+are recorded as tombstones (see channel_state.py) and not looked up again.
+
+A file whose channel another worker took over (see channel_state.py) is
+moved to 'UNFINISHED_PATH' abandoned/ instead of being finished, since
+that worker mines the channel again from the start.
+
+The settings of the run are loaded once at startup, see config.py.
+
 Attributes:
-    Imported from channel_scraper
+    RESUME_SEARCH_PAGES (int):
+        The number of pages, from the recorded page on, to look for the
+        last video on before falling back to scanning every upload.
+        New uploads push the last video onto later pages.
 """
 
 
 
-import requests
-import json
 import os
-from channel_scraper import *
+from contextlib import closing
+from itertools import chain, islice
+from api_client import ApiError, api_get
+from channel_scraper import (VIDEO_CHANNEL_FIELDS, abandon_channel_file,
+                             check_lease, csv_writer, datamine_channel,
+                             find_channel_vids, holding_leases,
+                             iter_upload_pages, move_completed_csv,
+                             prefetch_pages, Video)
+from channel_state import LeaseLost, get_store
+from config import load_config
+from metrics import get_metrics
+from delta_segments import iter_rows
+from output_writers import get_output_writer_for, is_channel_file, parse_date
+from quota import get_quota
+from response_cache import get_cache, print_cache_stats
+from run_journal import get_journal
+
+# variables
+RESUME_SEARCH_PAGES = 3
 
 
-def finish_data(UNFINISHED_PATH):
+def finish_data(config):
     """For each file in the 'UNFINISHED_PATH' directory, open the file
     and use the 'last video ID' to make an API request. From the request get
-    the channel ID, which is used to find every upload by the channel. Every
-    upload after the 'last video ID' will then be appended to the csv file.
+    the channel ID, which is used to find the uploads by the channel from
+    the page recorded at the last write, or from the first page if there
+    is none. Every upload after the 'last video ID' will then be appended
+    to the csv file.
     Finally, the file will be moved to the 'OUTPUT_PATH' directory.
 
     Args:
-        UNFINISHED_PATH (str): directory where the unfinished files are stored.
+        config (Config): the settings of the run, see config.py. The
+                         unfinished files are in its UNFINISHED_PATH.
 
     Returns:
         None
@@ -34,74 +76,197 @@ def finish_data(UNFINISHED_PATH):
         csv files will be completed and moved to the OUTPUT_PATH directory.
     """
 
-    file_list = get_file_list(UNFINISHED_PATH)
-    print(f"\nfile_list:\n{file_list}")
-    for file in file_list:
-        print(f"\n\n\nOn file {file}")
-        last_vid_id = get_last_vid_id(file)
-        print(f"\nlast_vid_id = {last_vid_id}")
-        channel_id = get_channel_id(last_vid_id)
-        print(f"\nchannel_id = {channel_id}")
+    get_metrics(config.METRICS_LOG_PATH, config.PROMETHEUS_PATH)
+    get_cache(config.CACHE_PATH)
+    get_store(config.COMPLETED_LINKS_FILEPATH, config.CHANNEL_STATE_PATH)
+    get_journal(config.JOURNAL_PATH)
+    with holding_leases(config):
+        for file in get_file_list(config.UNFINISHED_PATH):
+            try:
+                finish_file(file, config)
+            except LeaseLost as error:
+                print(f"\n{error}")
+                channel_name = os.path.basename(file).rsplit(".",1)[0]
+                abandon_channel_file(channel_name, config)
+
+def finish_file(file, config):
+    # Finish the channel of one unfinished file and move it to
+    # 'OUTPUT_PATH'.
+    print(f"\n\n\nOn file {file}")
+    channel_name_and_path = file.rsplit(".",1)[0]
+    channel_name = channel_name_and_path.split(config.UNFINISHED_PATH,1)[1]
+    last_row = get_output_writer_for(file).last_row(file)
+    last_vid_id = last_row[0]
+    # the anchor to resume from if last_vid_id was deleted
+    last_date = parse_date(last_row[2]) if last_row[2] else None
+    print(f"\nlast_vid_id = {last_vid_id}")
+    channel_id = find_channel_of_file(file, channel_name, last_vid_id)
+    if channel_id is None:
+        print(f"\nevery video looked up in {file} was deleted, "\
+              "leaving it for now")
+        return
+    print(f"\nchannel_id = {channel_id}")
+    if not get_store().lease(channel_id, config.WORKER_ID):
+        raise LeaseLost(channel_id)
+    last_vid = replay_journal(channel_name, channel_id, last_vid_id, config)
+    if last_vid is not None:
+        last_vid_id = last_vid.get_vid_id()
+        last_date = parse_date(last_vid.date) if last_vid.date else None
+        print(f"\nlast_vid_id = {last_vid_id}, from the run journal")
+    # new_vid_list is a generator, pages of uploads are
+    # requested as the videos after last_vid_id are datamined.
+    new_vid_list = resume_channel_vids(channel_id, last_vid_id, last_date,
+                                       config)
+    if new_vid_list is None:
         channel_link = "https://youtube.com/user/" + channel_id
         if len(channel_id) == 24:
             if channel_id.startswith("U"):
                 channel_link = "https://youtube.com/channel/" + channel_id
         print(f"\nchannel_link = {channel_link}")
-        vid_list, channel_name, channel_id = find_channel_vids(channel_link,
-                                                               True)
-        print(f"\nfinished find_channel_vids, {len(vid_list)}"\
-               " total videos found")
-        new_vid_list = remove_finished_videos(vid_list,last_vid_id)
-        print(f"\nfinished remove_finished_videos, {len(new_vid_list)}"\
-               " videos left to mine")
-
-        for finished_vid_list in datamine_channel(new_vid_list):
-            channel_name_and_path = file.rsplit(".",1)[0]
-            channel_name = channel_name_and_path.split(UNFINISHED_PATH,1)[1]
-            csv_writer(finished_vid_list,channel_name,
-                       UNFINISHED_PATH, channel_id)
-        move_completed_csv(channel_name, OUTPUT_PATH, UNFINISHED_PATH)
-        print(f"\ndone with {channel_name}")
+        vid_list, _, channel_id = find_channel_vids(channel_link,
+                                                    config, True)
+        new_vid_list = remove_finished_videos(vid_list, last_vid_id,
+                                              last_date, channel_id)
+
+    for finished_vid_list in datamine_channel(new_vid_list, config,
+                                              channel_id):
+        csv_writer(finished_vid_list, channel_name, channel_id, config)
+    check_lease(channel_id, config)
+    move_completed_csv(channel_name, config)
+    get_store().mark_complete(channel_id)
+    print(f"\ndone with {channel_name}")
+
+def replay_journal(channel_name, channel_id, last_vid_id, config):
+    # Write the videos of the channel a crashed run mined after
+    # last_vid_id but never wrote, from the run journal. Returns the last
+    # of them, or None if there are none.
+    journal = get_journal()
+    if journal is None:
+        return None
+    pending = journal.pending(channel_id)
+    vid_ids = [row[0] for row, page_token in pending]
+    if last_vid_id in vid_ids:
+        # written, the run crashed before clearing them
+        journal.clear(vid_ids[:vid_ids.index(last_vid_id) + 1])
+        pending = pending[vid_ids.index(last_vid_id) + 1:]
+    if not pending:
+        return None
+    vid_list = []
+    for row, page_token in pending:
+        vid = Video(*row[:4], page_token)
+        vid.add_data(row[4:])
+        vid_list.append(vid)
+    print(f"\nwriting the {len(vid_list)} videos the run journal holds")
+    get_metrics().count("journal_videos_replayed", len(vid_list))
+    csv_writer(vid_list, channel_name, channel_id, config)
+    return vid_list[-1]
 
 def get_file_list(UNFINISHED_PATH):
 
     file_list = []
     for file in os.listdir(UNFINISHED_PATH):
-        if file.endswith(".csv"):
+        if is_channel_file(file):
             file_list.append(os.path.join(UNFINISHED_PATH, file))
     return file_list
 
-def get_last_vid_id(filename):
-
-    with open(filename,'r') as file:
-        lines = file.read().splitlines()
-        counter = 1
-        last_vid_id = lines[-counter].split(",",1)[0]
-        while len(last_vid_id) < 10: # in case of empty line
-            counter += 1
-            last_vid_id = lines[-counter].split(",",1)[0]
-        return last_vid_id
+def find_channel_of_file(file, channel_name, last_vid_id):
+    # The channel id of an unfinished file, from the channel state store,
+    # or else from the first of its last and first videos the API still
+    # returns. None if every one of them was deleted.
+    store = get_store()
+    state = store.find_by_name(channel_name)
+    if state is not None:
+        return state["channel_id"]
+    with closing(iter_rows(file)) as rows:
+        vid_ids = [last_vid_id] + [row[0] for row in islice(rows, 10)]
+    tombstoned = store.tombstoned(vid_ids)
+    for vid_id in vid_ids:
+        if vid_id in tombstoned:
+            continue
+        channel_id = get_channel_id(vid_id)
+        if channel_id is not None:
+            return channel_id
+        print(f"\n{vid_id} was deleted or made private")
+        store.record_tombstones([vid_id], "not found")
+        tombstoned.add(vid_id)
+    return None
 
 def get_channel_id(vid_id):
+    # None if the video was deleted or made private
+    params = {"part": "snippet", "id": vid_id,
+              "fields": VIDEO_CHANNEL_FIELDS}
+    YT_video_list_response = api_get("videos", params)
+    if 'items' not in YT_video_list_response:
+        # an error body, not a sign the video is gone
+        raise ApiError(f"videos request failed: {YT_video_list_response}")
+    items = YT_video_list_response['items']
+    if not items:
+        return None
+    return items[0]['snippet']['channelId']
 
-    link = "https://www.googleapis.com/youtube/v3/videos?" \
-            f"part=snippet&id={vid_id}&key={API_KEY}"
-    YT_video_list_response = requests.get(link).json()
-    channel_id = YT_video_list_response['items'][0]['snippet']['channelId']
-    return channel_id
+def resume_channel_vids(channel_id, last_vid_id, last_date, config):
+    # Generator of the videos after last_vid_id, paging from the page
+    # recorded when last_vid_id was written. If last_vid_id was deleted,
+    # the videos published before last_date. Returns None if no page
+    # was recorded or neither is found near it.
+    state = get_store().get(channel_id)
+    if not state or not state["page_token"] or not state["playlist_id"] \
+            or state["last_vid_id"] != last_vid_id:
+        print("\nno page recorded for last_vid_id, scanning every upload")
+        return None
+    print(f"\nresuming from page {state['page_token']}")
+    pages = iter_upload_pages(state["playlist_id"], state["page_token"])
+    for page in islice(pages, RESUME_SEARCH_PAGES):
+        position = unmined_position(page, last_vid_id, last_date,
+                                    channel_id)
+        if position is not None:
+            return chain(page[position:], chain.from_iterable(
+                             prefetch_pages(pages, config.PREFETCH_PAGES)))
+    print(f"\nlast_vid_id not found in {RESUME_SEARCH_PAGES} pages from "\
+          "the recorded page, scanning every upload")
+    return None
 
-def remove_finished_videos(vid_list,last_vid_id):
+def remove_finished_videos(vid_list, last_vid_id, last_date = None,
+                           channel_id = None):
+    # Generator of the videos in vid_list after last_vid_id, or after
+    # last_date if last_vid_id was deleted.
+    found = False
+    for vid in vid_list:
+        if found:
+            yield vid
+        elif unmined_position([vid], last_vid_id, last_date,
+                              channel_id) is not None:
+            found = True
+            if vid.get_vid_id() != last_vid_id:
+                yield vid
+    if not found:
+        # if you never find last_vid_id
+        print("\nlast_vid_id never found, no videos left to mine")
 
-    for i in range(len(vid_list)):
-        vid_id = vid_list[i].get_vid_id()
-        if vid_id == last_vid_id:
+def unmined_position(page, last_vid_id, last_date, channel_id = None):
+    # The position in page, uploads from newest to oldest, of the first
+    # video not mined yet: the one after last_vid_id or, if last_vid_id
+    # was deleted, the first one published before last_date. None if
+    # every video of page was mined.
+    for i, vid in enumerate(page):
+        if vid.get_vid_id() == last_vid_id:
             print(f"\nfound last_vid_id = {last_vid_id}")
-            return vid_list[i+1:]
-    print("\nlast_vid_id never found, returning []")
-    return [] # if you never find last_vid_id
+            return i + 1
+        if last_date is not None and parse_date(vid.date) < last_date:
+            print(f"\n{last_vid_id} is no longer in the uploads, "\
+                  f"resuming from {vid.get_vid_id()}, the first video "\
+                  "published before it")
+            get_store().record_tombstones([last_vid_id],
+                                          "not in the uploads", channel_id)
+            return i
+    return None
 
 if __name__ == "__main__":
-    API_KEY = get_api_key()
+    config = load_config(description = "Finish data-mining any channels "
+                                       "with files in UNFINISHED_PATH.")
+    get_quota(config.API_KEYS, config.QUOTA_PATH)
     print("\n\nStarting channel_finisher.py")
-    finish_data(UNFINISHED_PATH)
-    print("\n\nAll files completed")
\ No newline at end of file
+    finish_data(config)
+    print("\n\nAll files completed")
+    print_cache_stats()
+    get_metrics().flush()
\ No newline at end of file
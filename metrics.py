@@ -0,0 +1,228 @@
+"""Counters and latency histograms of a scraping run.
+
+api_client and the functions on the hot path of channel_scraper record
+what they do here: the latency of every API request by endpoint, the
+bytes received, retries, cache hits, the quota units spent, how long the
+json parsing and the writing of rows take, and the rows written. That
+tells whether a slow run is waiting on the API, parsing json or writing
+files.
+
+Recording a value only updates a dict under a lock. At most every
+LOG_INTERVAL seconds, and once more at the end of a run (flush), a
+snapshot of every metric is appended to 'METRICS_LOG_PATH' as one json
+line and, if 'PROMETHEUS_PATH' is set, written in the Prometheus text
+format, e.g. for the textfile collector of node_exporter. So the
+output does not slow the loop down however many videos are datamined.
+
+Attributes:
+    METRICS_LOG_PATH (str):
+        The default filepath of the json lines log, the
+        METRICS_LOG_PATH setting of config.py. An empty path turns
+        the log off.
+
+    PROMETHEUS_PATH (str):
+        The default filepath to write the Prometheus text format to,
+        the PROMETHEUS_PATH setting of config.py. None to not write it.
+
+    LOG_INTERVAL (float):
+        The least number of seconds between two snapshots.
+
+    LATENCY_BUCKETS (tuple of float):
+        The upper bounds, in seconds, of the histogram buckets.
+"""
+
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+
+# variables
+METRICS_LOG_PATH = "cache/metrics.jsonl"
+PROMETHEUS_PATH = None
+LOG_INTERVAL = 10.0
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0)
+
+PROMETHEUS_PREFIX = "yt_scraper_"
+
+METRICS = None
+METRICS_LOCK = threading.Lock()
+
+
+class Metrics(object):
+
+    def __init__(self, log_path = None, prometheus_path = None,
+                 interval = LOG_INTERVAL):
+
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.counters = {}   # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [bucket counts, sum]
+        self.started = time.time()
+        self.next_flush = time.monotonic() + interval
+
+    def count(self, name, amount = 1, **labels):
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        self.maybe_flush()
+
+    def observe(self, name, seconds, **labels):
+        # Add one value to a histogram.
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+                self.histograms[key] = histogram
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+        self.maybe_flush()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Observe the seconds the 'with' block takes.
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def maybe_flush(self):
+        # one comparison unless a snapshot is due
+        if time.monotonic() < self.next_flush:
+            return
+        if not self.flush_lock.acquire(blocking = False):
+            return # another thread is writing it
+        try:
+            self.write_snapshot()
+        finally:
+            self.flush_lock.release()
+
+    def flush(self):
+
+        with self.flush_lock:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+
+        self.next_flush = time.monotonic() + self.interval
+        snapshot = self.snapshot()
+        if self.log_path:
+            make_parent_dir(self.log_path)
+            with open(self.log_path, "a") as file:
+                file.write(json.dumps(snapshot) + "\n")
+        if self.prometheus_path:
+            make_parent_dir(self.prometheus_path)
+            # written aside then renamed, so it is never read half written
+            temp_path = self.prometheus_path + ".tmp"
+            with open(temp_path, "w") as file:
+                file.write(prometheus_text(snapshot))
+            os.replace(temp_path, self.prometheus_path)
+
+    def snapshot(self):
+        # Every metric as json, histogram buckets are cumulative.
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels),
+                         "value": value}
+                        for (name, labels), value in self.counters.items()]
+            histograms = []
+            for (name, labels), (buckets, total) in self.histograms.items():
+                cumulative = []
+                running = 0
+                for count in buckets:
+                    running += count
+                    cumulative.append(running)
+                histograms.append({"name": name, "labels": dict(labels),
+                                   "count": running, "sum": total,
+                                   "buckets": cumulative})
+        return {"time": datetime.now(timezone.utc).isoformat(),
+                "elapsed": round(time.time() - self.started, 3),
+                "pid": os.getpid(),
+                "counters": counters,
+                "histograms": histograms}
+
+
+def get_metrics(log_path = None, prometheus_path = None):
+    # The metrics shared by every thread. They are written to log_path
+    # and prometheus_path, usually the settings of the same names of the
+    # Config, given the first time it is called, or to METRICS_LOG_PATH
+    # and PROMETHEUS_PATH if none are given.
+    global METRICS
+    if METRICS is not None:
+        return METRICS
+    with METRICS_LOCK:
+        if METRICS is None:
+            if log_path is None:
+                log_path = METRICS_LOG_PATH
+            if prometheus_path is None:
+                prometheus_path = PROMETHEUS_PATH
+            METRICS = Metrics(log_path, prometheus_path)
+        return METRICS
+
+def timed(stage):
+    # Decorator observing the seconds every call of a function takes,
+    # as the 'stage_seconds' histogram of 'stage'.
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                get_metrics().observe("stage_seconds",
+                                      time.perf_counter() - start,
+                                      stage = stage)
+        return wrapper
+    return decorator
+
+def prometheus_text(snapshot):
+    # The Prometheus text exposition format of a snapshot.
+    lines = []
+    typed = set()
+    for counter in sorted(snapshot["counters"],
+                          key = lambda counter: counter["name"]):
+        name = PROMETHEUS_PREFIX + counter["name"] + "_total"
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{label_text(counter['labels'])} "
+                     f"{counter['value']}")
+    for histogram in sorted(snapshot["histograms"],
+                            key = lambda histogram: histogram["name"]):
+        name = PROMETHEUS_PREFIX + histogram["name"]
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        labels = histogram["labels"]
+        bounds = [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+        for bound, count in zip(bounds, histogram["buckets"]):
+            lines.append(f"{name}_bucket"
+                         f"{label_text(dict(labels, le = bound))} {count}")
+        lines.append(f"{name}_sum{label_text(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{label_text(labels)} "
+                     f"{histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+def label_text(labels):
+
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+def make_parent_dir(path):
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
@@ -0,0 +1,407 @@
+"""Local stand-in for the YouTube Data API, for benchmarks.
+
+MockYouTubeAPI serves the three endpoints the scraper uses, with the same
+json layout as the API:
+
+    channels        by 'id' (up to 50, comma separated) or
+                    'forUsername', with contentDetails and
+                    statistics.videoCount
+    playlistItems   the uploads of a channel, newest first, 'maxResults'
+                    at a time, paged with 'pageToken'
+    videos          'snippet' or 'statistics' for up to 50 comma
+                    separated ids
+
+The channels are synthetic: add_channel(video_count) makes a channel with
+that many uploads, and add_uploads puts new videos at the top of a
+channel, like a channel uploading between two runs of update_data, and
+delete_video takes a video out of the uploads and the videos endpoint,
+like a video that was deleted or made private. Every
+video id encodes its channel and upload number, so any number of uploads
+costs no memory. There can be up to 1000 channels of up to 10M uploads.
+
+The 'fields' parameter selects parts of a response like the API does,
+e.g. fields=items(id,snippet/channelId), see project.
+
+Every response has an ETag, a hash of its body, and a request whose
+'If-None-Match' header matches it gets an empty 304 Not Modified.
+
+Latency, server errors (500) and rate limiting (429, with a 'Retry-After'
+of 0) can be injected to see how the client copes. Every request is
+counted in 'stats'.
+
+Point api_client at it with
+    api_client.API_BASE_URL = api.start()
+
+Attributes:
+    RESULTS_PER_PAGE (int):
+        The most playlistItems a page holds, like the API.
+"""
+
+
+import argparse
+import bisect
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# variables
+RESULTS_PER_PAGE = 50
+FIRST_UPLOAD = datetime(2010, 1, 1, tzinfo = timezone.utc)
+
+
+class MockYouTubeAPI(object):
+
+    def __init__(self, latency = 0.0, error_rate = 0.0,
+                 rate_limit_rate = 0.0, seed = 0):
+
+        self.latency = latency                  # seconds per request
+        self.error_rate = error_rate            # share of 500 responses
+        self.rate_limit_rate = rate_limit_rate  # share of 429 responses
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.channels = [] # upload count per channel number
+        self.deleted = {}  # channel number -> sorted deleted uploads
+        self.stats = {}
+        self.server = None
+        self.thread = None
+
+    def add_channel(self, video_count):
+        # Make a channel with video_count uploads, returns its link.
+        with self.lock:
+            self.channels.append(video_count)
+            number = len(self.channels) - 1
+        return "https://www.youtube.com/channel/" + channel_id(number)
+
+    def add_uploads(self, channel_link, video_count):
+
+        number = channel_number(channel_link.rsplit("/",1)[-1])
+        with self.lock:
+            self.channels[number] += video_count
+
+    def delete_video(self, vid_id):
+
+        number, upload = parse_video_id(vid_id)
+        with self.lock:
+            deleted = self.deleted.setdefault(number, [])
+            if upload not in deleted:
+                bisect.insort(deleted, upload)
+
+    def is_deleted(self, number, upload):
+
+        deleted = self.deleted.get(number, [])
+        i = bisect.bisect_left(deleted, upload)
+        return i < len(deleted) and deleted[i] == upload
+
+    def upload_at(self, number, position):
+        # The upload at position in the uploads, 0 being the newest,
+        # deleted uploads skipped. Costs a step per deleted upload above
+        # it, not per upload.
+        deleted = self.deleted.get(number, [])
+        upload = self.channels[number] - 1 - position
+        while True:
+            above = len(deleted) - bisect.bisect_left(deleted, upload)
+            candidate = self.channels[number] - 1 - position - above
+            if candidate == upload:
+                return upload
+            upload = candidate
+
+    def count(self, name, amount = 1):
+
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def start(self, host = "127.0.0.1", port = 0):
+        # Serve from a background thread, returns the base url.
+        api = self
+
+        class Handler(MockRequestHandler):
+            mock_api = api
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target = self.server.serve_forever,
+                                       daemon = True)
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/youtube/v3/"
+
+    def stop(self):
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def respond(self, endpoint, params, if_none_match = None):
+        # The status code, headers and json body of a request, the body
+        # is None for a 304.
+        self.count("requests")
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.count("rate_limited")
+            return 429, {"Retry-After": "0"}, error_body(429,
+                                                         "rateLimitExceeded")
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.count("errors")
+            return 500, {}, error_body(500, "backendError")
+
+        if endpoint == "channels":
+            body = self.list_channels(params)
+        elif endpoint == "playlistItems":
+            body = self.list_playlist_items(params)
+        elif endpoint == "videos":
+            body = self.list_videos(params)
+        else:
+            return 404, {}, error_body(404, "notFound")
+        self.count(endpoint)
+        selection = None
+        if params.get("fields"):
+            selection = parse_fields(params["fields"])
+            body = project(body, selection)
+        etag = '"' + hashlib.md5(json.dumps(body, sort_keys = True)
+                                 .encode("utf-8")).hexdigest() + '"'
+        if if_none_match == etag:
+            self.count("not_modified")
+            return 304, {"ETag": etag}, None
+        if selection is None or "etag" in selection:
+            body["etag"] = etag
+        return 200, {"ETag": etag}, body
+
+    def list_channels(self, params):
+
+        channels = params.get("id") or params.get("forUsername") or ""
+        items = []
+        for channel in channels.split(",")[:RESULTS_PER_PAGE]:
+            try:
+                number = channel_number(channel)
+                video_count = self.channels[number]
+            except (ValueError, IndexError):
+                continue
+            video_count -= len(self.deleted.get(number, []))
+            items.append({"id": channel_id(number),
+                          "contentDetails": {"relatedPlaylists": {
+                              "uploads": "UU" + channel_id(number)[2:]}},
+                          "statistics": {"videoCount": str(video_count)}})
+        return {"kind": "youtube#channelListResponse", "items": items}
+
+    def list_playlist_items(self, params):
+
+        number = channel_number("UC" + params["playlistId"][2:])
+        video_count = self.channels[number] - len(self.deleted.get(number,
+                                                                   []))
+        per_page = min(int(params.get("maxResults", 5)), RESULTS_PER_PAGE)
+        offset = int(params.get("pageToken", "P0")[1:])
+        items = []
+        # position 0 is the newest upload
+        for position in range(offset, min(video_count, offset + per_page)):
+            upload = self.upload_at(number, position)
+            items.append({"snippet": {
+                "channelId": channel_id(number),
+                "channelTitle": channel_title(number),
+                "title": f"Upload {upload}, \"part\" {upload % 7}",
+                "publishedAt": published_at(upload),
+                "resourceId": {"kind": "youtube#video",
+                               "videoId": video_id(number, upload)},
+                "thumbnails": {"default": {
+                    "url": f"https://i.ytimg.com/vi/"
+                           f"{video_id(number, upload)}/default.jpg"}}}})
+        body = {"kind": "youtube#playlistItemListResponse", "items": items,
+                "pageInfo": {"totalResults": video_count,
+                             "resultsPerPage": per_page}}
+        if offset + per_page < video_count:
+            body["nextPageToken"] = f"P{offset + per_page}"
+        return body
+
+    def list_videos(self, params):
+
+        parts = params.get("part", "").split(",")
+        items = []
+        for vid_id in params.get("id", "").split(",")[:RESULTS_PER_PAGE]:
+            try:
+                number, upload = parse_video_id(vid_id)
+                if upload >= self.channels[number] \
+                        or self.is_deleted(number, upload):
+                    continue
+            except (ValueError, IndexError):
+                continue # unknown videos are left out, like deleted ones
+            item = {"kind": "youtube#video", "id": vid_id}
+            if "snippet" in parts:
+                item["snippet"] = {"channelId": channel_id(number),
+                                   "channelTitle": channel_title(number),
+                                   "publishedAt": published_at(upload)}
+            if "statistics" in parts:
+                item["statistics"] = {
+                    "viewCount": str(upload * 7919 % 1000003),
+                    "likeCount": str(upload * 31 % 10007),
+                    "dislikeCount": str(upload % 101),
+                    "commentCount": str(upload * 13 % 1009)}
+            items.append(item)
+        if "statistics" in parts:
+            self.count("video_statistics", len(items))
+        return {"kind": "youtube#videoListResponse", "items": items}
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+
+    # keep-alive, so the client's connection pooling is measured too
+    protocol_version = "HTTP/1.1"
+    # the headers and body are sent separately, without this every
+    # response would wait for the client's delayed ACK
+    disable_nagle_algorithm = True
+    mock_api = None
+
+    def do_GET(self):
+
+        url = urlparse(self.path)
+        endpoint = url.path.rstrip("/").rsplit("/",1)[-1]
+        params = {name: values[-1]
+                  for name, values in parse_qs(url.query).items()}
+        status, headers, body = self.mock_api.respond(
+                                    endpoint, params,
+                                    self.headers.get("If-None-Match"))
+        data = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # one line per request would drown the benchmark output
+        pass
+
+
+def channel_id(number):
+    # 24 characters starting with UC, like a real channel id
+    return f"UCmockchannel{number:011d}"
+
+def channel_number(channel):
+
+    if not channel.startswith("UCmockchannel"):
+        raise ValueError(f"{channel} is not a mock channel")
+    return int(channel[len("UCmockchannel"):])
+
+def channel_title(number):
+    return f"Mock Channel {number}"
+
+def video_id(number, upload):
+    # 11 characters, like a real video id
+    return f"v{number:03d}{upload:07d}"
+
+def parse_video_id(vid_id):
+
+    if len(vid_id) != 11 or not vid_id.startswith("v"):
+        raise ValueError(f"{vid_id} is not a mock video")
+    return int(vid_id[1:4]), int(vid_id[4:])
+
+def published_at(upload):
+    # one upload an hour, from FIRST_UPLOAD on
+    date = FIRST_UPLOAD + timedelta(hours = upload)
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def parse_fields(fields):
+    # "a,b/c,d(e,f)" -> {"a": None, "b": {"c": None},
+    # "d": {"e": None, "f": None}}, None selects the whole value.
+    selection, position = parse_field_list(fields, 0)
+    if position != len(fields):
+        raise ValueError(f"Invalid fields {fields}")
+    return selection
+
+def parse_field_list(fields, position):
+
+    selection = {}
+    while position < len(fields):
+        end = position
+        while end < len(fields) and fields[end] not in ",/()":
+            end += 1
+        name = fields[position:end]
+        position = end
+        sub_selection = None
+        if position < len(fields) and fields[position] == "/":
+            sub_selection, position = parse_field_path(fields,
+                                                            position + 1)
+        elif position < len(fields) and fields[position] == "(":
+            sub_selection, position = parse_field_list(fields, position + 1)
+            position += 1 # the closing parenthesis
+        merge_selection(selection, name, sub_selection)
+        if position < len(fields) and fields[position] == ",":
+            position += 1
+            continue
+        break
+    return selection, position
+
+def parse_field_path(fields, position):
+    # the part after a "/", which selects a single field
+    end = position
+    while end < len(fields) and fields[end] not in ",/()":
+        end += 1
+    name = fields[position:end]
+    sub_selection = None
+    if end < len(fields) and fields[end] == "/":
+        sub_selection, end = parse_field_path(fields, end + 1)
+    elif end < len(fields) and fields[end] == "(":
+        sub_selection, end = parse_field_list(fields, end + 1)
+        end += 1
+    return {name: sub_selection}, end
+
+def merge_selection(selection, name, sub_selection):
+
+    if name in selection and selection[name] is not None \
+            and sub_selection is not None:
+        for sub_name, value in sub_selection.items():
+            merge_selection(selection[name], sub_name, value)
+    elif name in selection and selection[name] is None:
+        return
+    else:
+        selection[name] = sub_selection
+
+def project(value, selection):
+    # The parts of a json value a parsed 'fields' selects.
+    if selection is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, selection) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {name: project(value[name], sub_selection)
+            for name, sub_selection in selection.items() if name in value}
+
+def error_body(code, reason):
+
+    return {"error": {"code": code, "message": reason,
+                      "errors": [{"reason": reason}]}}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Serve a local stand-in "
+                                     "for the YouTube Data API.")
+    parser.add_argument("--port", type = int, default = 8080)
+    parser.add_argument("--channels", default = "10,1000,100000",
+                        help = "comma separated upload counts")
+    parser.add_argument("--latency", type = float, default = 0.0,
+                        help = "seconds per request")
+    parser.add_argument("--error-rate", type = float, default = 0.0)
+    parser.add_argument("--rate-limit-rate", type = float, default = 0.0)
+    arguments = parser.parse_args()
+
+    api = MockYouTubeAPI(arguments.latency, arguments.error_rate,
+                         arguments.rate_limit_rate)
+    for video_count in arguments.channels.split(","):
+        print(api.add_channel(int(video_count)))
+    print(f"\nserving on {api.start(port = arguments.port)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        api.stop()
@@ -0,0 +1,333 @@
+"""Output formats the data of a channel can be written in.
+
+csv_writer, move_completed_csv and csv_updater write a channel's data
+through one of the writers of this module instead of writing csv files
+themselves. Every writer has the same methods, so a new format only needs
+a new writer class here:
+
+    append(path, header, vid_list): add rows after the existing rows,
+        creating path with the header if it does not exist yet.
+    move(src, dst): move a completed channel to its final place, in one
+        rename, so dst never holds part of a channel.
+    replace(src, dst): replace dst with src.
+    header(path): the column names of path.
+    iter_rows(path): generator of every row of path, in order.
+    last_row(path): the last row of path.
+    size(path): the number of bytes path takes on disk.
+    merge(sources, dst): write the rows of every source, in order, to dst.
+
+CsvOutput writes one csv file per channel, as the module always has.
+ParquetOutput writes a channel as a directory of parquet files, one per
+call to append, so every 'MAX_VIDEOS' flush becomes its own row group.
+Counts are typed int64, 'date' is a UTC timestamp and the columns are
+dictionary encoded, which makes the files much smaller and much faster
+to scan than csv. ParquetOutput needs the pyarrow module.
+
+Attributes:
+    TAIL_BLOCK_SIZE (int):
+        The number of bytes CsvOutput.last_row reads at a time,
+        backward from the end of the file.
+"""
+
+
+import csv
+import errno
+import io
+import os
+import shutil
+from datetime import datetime, timezone
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# variables
+TAIL_BLOCK_SIZE = 8192
+
+
+class CsvOutput(object):
+
+    extension = ".csv"
+
+    def append(self, path, header, vid_list):
+
+        file_exists = os.path.exists(path)
+        with open(path, 'a', newline = '') as file:
+            writer = csv.writer(file)
+            if not file_exists:
+                writer.writerow(header)
+            writer.writerows((vid.id, vid.title, vid.date, vid.thumbnail,
+                              *vid.data) for vid in vid_list)
+
+    def move(self, src, dst):
+        # the rows are made durable before the file appears in dst
+        fsync_file(src)
+        move_path(src, dst, copy_file)
+
+    def replace(self, src, dst):
+        os.replace(src, dst)
+
+    def header(self, path):
+
+        with open(path, "r", newline = "") as file:
+            return next(csv.reader(file))
+
+    def iter_rows(self, path):
+        # rows are lists of str, the header is skipped
+        with open(path, "r", newline = "") as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            for row in reader:
+                yield row
+
+    def last_row(self, path):
+        # Reads the file backward from the end, a block at a time, until
+        # the blocks hold a whole row, so the cost does not grow with the
+        # size of the file.
+        with open(path, "rb") as file:
+            position = file.seek(0, os.SEEK_END)
+            tail = b""
+            while position > 0:
+                step = min(TAIL_BLOCK_SIZE, position)
+                position -= step
+                file.seek(position)
+                tail = file.read(step) + tail
+                row = last_csv_row(tail, position == 0)
+                if row is not None:
+                    return row
+        raise ValueError(f"{path} has no rows")
+
+    def size(self, path):
+        return os.path.getsize(path)
+
+    def merge(self, sources, dst):
+
+        with open(dst, "w", newline = "") as file:
+            with open(sources[-1], "r", newline = "") as source:
+                file.write(source.readline()) # header
+            for path in sources:
+                with open(path, "r", newline = "") as source:
+                    source.readline() # header
+                    for line in source:
+                        file.write(line)
+
+
+class ParquetOutput(object):
+
+    extension = ".parquet"
+
+    def __init__(self):
+
+        if pa is None:
+            raise ImportError("The pyarrow module is necessary to write "
+                              "parquet files, install it or set "
+                              "OUTPUT_FORMAT to 'csv'")
+
+    def schema(self, header):
+        # id, title, date, thumbnail, then one int64 per RELEVANT_DATA
+        fields = [pa.field("id", pa.string()),
+                  pa.field("title", pa.string()),
+                  pa.field("date", pa.timestamp("s", tz = "UTC")),
+                  pa.field("thumbnail", pa.string())]
+        fields += [pa.field(name, pa.int64()) for name in header[4:]]
+        return pa.schema(fields)
+
+    def to_table(self, header, vid_list):
+        # built a column at a time, counts are already ints
+        columns = [[vid.id for vid in vid_list],
+                   [vid.title for vid in vid_list],
+                   [parse_date(vid.date) for vid in vid_list],
+                   [vid.thumbnail for vid in vid_list]]
+        for i in range(len(header) - 4):
+            columns.append([vid.data[i] for vid in vid_list])
+        return pa.Table.from_arrays(columns, schema = self.schema(header))
+
+    def parts(self, path):
+        # the parquet files of a channel, in the order they were written
+        if not os.path.isdir(path):
+            return []
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.endswith(".parquet")]
+
+    def append(self, path, header, vid_list):
+
+        os.makedirs(path, exist_ok = True)
+        parts = self.parts(path)
+        number = 0
+        if parts:
+            number = int(os.path.basename(parts[-1])[5:-8]) + 1
+        part = os.path.join(path, f"part-{number:06d}.parquet")
+        table = self.to_table(header, vid_list)
+        # written under another name first, so a crash never
+        # leaves half a part in the channel
+        pq.write_table(table, part + ".tmp", use_dictionary = True,
+                       row_group_size = max(1, table.num_rows))
+        os.replace(part + ".tmp", part)
+
+    def move(self, src, dst):
+
+        for part in self.parts(src):
+            fsync_file(part)
+        fsync_directory(src)
+        move_path(src, dst, copy_directory, self.replace)
+
+    def replace(self, src, dst):
+        # a directory can't replace a directory in one rename, so the old
+        # one is moved aside first. Calling replace again after a crash
+        # finishes the job.
+        old = dst + ".old"
+        if os.path.exists(dst):
+            if os.path.exists(old):
+                shutil.rmtree(old)
+            os.replace(dst, old)
+        os.replace(src, dst)
+        shutil.rmtree(old, ignore_errors = True)
+
+    def header(self, path):
+        return pq.read_schema(self.parts(path)[0]).names
+
+    def iter_rows(self, path):
+        # rows are lists of python values, 'date' is a datetime
+        for part in self.parts(path):
+            for batch in pq.ParquetFile(part).iter_batches():
+                columns = [column.to_pylist() for column in batch.columns]
+                for row in zip(*columns):
+                    yield list(row)
+
+    def last_row(self, path):
+        # 'date' is a datetime
+        table = pq.read_table(self.parts(path)[-1])
+        return [column[0] for column in
+                table.slice(table.num_rows - 1).to_pydict().values()]
+
+    def size(self, path):
+        return sum(os.path.getsize(part) for part in self.parts(path))
+
+    def merge(self, sources, dst):
+
+        os.makedirs(dst, exist_ok = True)
+        schema = pq.read_schema(self.parts(sources[-1])[0])
+        with pq.ParquetWriter(os.path.join(dst, "part-000000.parquet"),
+                              schema, use_dictionary = True) as writer:
+            for path in sources:
+                for part in self.parts(path):
+                    writer.write_table(pq.read_table(part, schema = schema))
+
+
+OUTPUT_WRITERS = {"csv": CsvOutput, "parquet": ParquetOutput}
+
+
+def get_output_writer(output_format):
+    # The writer of an OUTPUT_FORMAT name, "csv" or "parquet".
+    try:
+        return OUTPUT_WRITERS[output_format]()
+    except KeyError:
+        raise ValueError(f"Unknown output format {output_format}, "
+                         f"choose one of {list(OUTPUT_WRITERS)}")
+
+def get_output_writer_for(path):
+    # The writer of an existing channel file or directory.
+    for output_format, writer in OUTPUT_WRITERS.items():
+        if path.endswith(writer.extension):
+            return writer()
+    raise ValueError(f"{path} is not a file of a known output format")
+
+def is_channel_file(name):
+
+    return any(name.endswith(writer.extension)
+               for writer in OUTPUT_WRITERS.values())
+
+def last_csv_row(tail, at_start):
+    # The last non-empty row of 'tail', the end of a csv file, or None if
+    # tail does not hold a whole row yet. A newline starts a row only if
+    # the number of quotes after it is even, otherwise it is inside a
+    # quoted field, e.g. a title with a line break.
+    starts = []
+    newline = tail.rfind(b"\n")
+    while newline != -1:
+        starts.append(newline + 1)
+        newline = tail.rfind(b"\n", 0, newline)
+    if at_start:
+        starts.append(0)
+    for start in starts:
+        if tail.count(b'"', start) % 2:
+            continue
+        text = tail[start:].decode("utf-8")
+        rows = [row for row in csv.reader(io.StringIO(text, newline = ""))
+                if row]
+        if start == 0:
+            rows = rows[1:] # header
+        if rows:
+            return rows[-1]
+    return None
+
+def move_path(src, dst, copy, rename = os.replace):
+    # Rename src to dst with rename(src, dst). Across filesystems, where
+    # a rename is not possible, src is copied next to dst under a
+    # temporary name with copy(src, temp) and that is renamed instead,
+    # then src is removed.
+    try:
+        rename(src, dst)
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+        temp = dst + ".tmp"
+        copy(src, temp)
+        rename(temp, dst)
+        fsync_directory(os.path.dirname(dst))
+        if os.path.isdir(src):
+            shutil.rmtree(src)
+        else:
+            os.remove(src)
+        fsync_directory(os.path.dirname(src))
+        return
+    fsync_directory(os.path.dirname(dst))
+    fsync_directory(os.path.dirname(src))
+
+def copy_file(src, dst):
+    # streamed, the file is never read into memory at once
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        shutil.copyfileobj(fin, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+
+def copy_directory(src, dst):
+
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    os.makedirs(dst)
+    for name in os.listdir(src):
+        copy_file(os.path.join(src, name), os.path.join(dst, name))
+    fsync_directory(dst)
+
+def fsync_file(path):
+
+    with open(path, "rb+") as file:
+        os.fsync(file.fileno())
+
+def fsync_directory(path):
+    # Make the renames in a directory durable. Directories can't be
+    # opened on Windows, where there is nothing to do.
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def parse_date(date):
+    # "2020-03-23T21:57:00Z" -> datetime in UTC, a datetime, like the
+    # dates of parquet files, is returned as is
+    if isinstance(date, datetime):
+        return date
+    parsed = datetime.fromisoformat(date.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo = timezone.utc)
+    return parsed
@@ -0,0 +1,223 @@
+"""Quota accounting for the YouTube Data API keys.
+
+Every API key gets DAILY_QUOTA units a day, and every request the scraper
+makes costs the units given in UNIT_COSTS (the channels, playlistItems and
+videos list requests cost 1 unit each, whatever the number of ids or
+results). api_client.api_get records the units of every request it sends
+against the key it used, per key and per quota day, in a SQLite database,
+so several scripts and processes share the same accounting. A quota day
+starts at midnight Pacific time, when the API resets its quota.
+
+Several keys can be listed in 'API_KEY_PATH', one per line. Requests use
+the first key with units left, and move on to the next key once it runs
+out. A key the API reports as out of quota is marked as used up for the
+rest of the day, whatever this module counted.
+
+Before channel_scraper starts a channel, it estimates the units mining it
+will cost (estimate_channel_cost) and reserves them. A channel whose
+estimate does not fit in the units left, after the reservations of the
+channels being mined, is not started today, so runs end between channels
+instead of half way through one. A channel that costs more than every
+key gets in a day is reserved the whole day instead: it starts once no
+unit has been spent today, and finish_data mines the rest of it on the
+next days. The thread mining a channel charges its
+requests to the channel (charge_to), and every unit spent comes off the
+channel's reservation, since the units left already count it.
+
+Attributes:
+    API_KEY_PATH (str):
+        The filepath for a .txt file where each line is an API key.
+
+    QUOTA_PATH (str):
+        The default filepath of the SQLite database the units spent are
+        kept in, the QUOTA_PATH setting of config.py.
+
+    DAILY_QUOTA (int):
+        The number of units each key gets a day.
+
+    UNIT_COSTS (dict of str: int):
+        The units a request to each endpoint costs.
+"""
+
+
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+except Exception: # no time zone database
+    QUOTA_TIMEZONE = timezone(timedelta(hours = -8))
+
+from channel_state import Transaction
+
+# variables
+API_KEY_PATH = "api_key.txt"
+QUOTA_PATH = "cache/quota.sqlite"
+DAILY_QUOTA = 10000
+UNIT_COSTS = {"channels": 1, "playlistItems": 1, "videos": 1}
+
+RESULTS_PER_PAGE = 50
+
+QUOTA = None
+QUOTA_LOCK = threading.Lock()
+CHARGE = threading.local()
+
+
+class QuotaExhausted(Exception):
+    """Every API key has run out of quota for the day."""
+
+
+class OverBudget(Exception):
+    """A channel would cost more units than there are left today."""
+
+
+class QuotaManager(object):
+
+    def __init__(self, api_keys, path, daily_quota = DAILY_QUOTA):
+
+        if not api_keys:
+            raise ValueError("No API key was given")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.api_keys = api_keys
+        self.daily_quota = daily_quota
+        self.path = path
+        self.lock = threading.Lock()
+        self.reservation_lock = threading.Lock()
+        self.reservations = {} # channel id -> units
+        self.connection = sqlite3.connect(path, timeout = 60,
+                                          check_same_thread = False,
+                                          isolation_level = None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        # keys are stored hashed, the database never holds a key
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            " key_hash TEXT NOT NULL,"
+            " day TEXT NOT NULL,"
+            " units INTEGER NOT NULL,"
+            " PRIMARY KEY (key_hash, day))")
+
+    def transaction(self):
+        return Transaction(self)
+
+    def spent(self, api_key):
+        # Units spent today with api_key.
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT units FROM usage WHERE key_hash = ? AND day = ?",
+                (key_hash(api_key), quota_day())).fetchone()
+        return row[0] if row else 0
+
+    def remaining(self, api_key):
+        return max(0, self.daily_quota - self.spent(api_key))
+
+    def total_remaining(self):
+        return sum(self.remaining(api_key) for api_key in self.api_keys)
+
+    def key_for(self, units = 1):
+        # The first key with 'units' left today.
+        for api_key in self.api_keys:
+            if self.remaining(api_key) >= units:
+                return api_key
+        raise QuotaExhausted(f"All {len(self.api_keys)} API keys are out "
+                             f"of quota until midnight Pacific time")
+
+    def spend(self, api_key, endpoint):
+
+        units = UNIT_COSTS.get(endpoint, 1)
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO usage VALUES (?, ?, ?)"
+                " ON CONFLICT (key_hash, day) DO UPDATE SET"
+                " units = units + excluded.units",
+                (key_hash(api_key), quota_day(), units))
+        channel_id = charged_channel()
+        if channel_id is not None:
+            with self.reservation_lock:
+                if channel_id in self.reservations:
+                    self.reservations[channel_id] = max(
+                        0, self.reservations[channel_id] - units)
+
+    def mark_exhausted(self, api_key):
+        # The API says the key is out of quota, believe it.
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO usage VALUES (?, ?, ?)",
+                (key_hash(api_key), quota_day(), self.daily_quota))
+
+    def reserve(self, channel_id, units):
+        # Reserve the units a channel is estimated to cost, at most a full
+        # day of every key. Returns False, and reserves nothing, if they
+        # do not fit in the units left.
+        units = min(units, self.daily_quota * len(self.api_keys))
+        with self.reservation_lock:
+            reserved = sum(self.reservations.values())
+            if units > self.total_remaining() - reserved:
+                return False
+            self.reservations[channel_id] = units
+            return True
+
+    def release(self, channel_id):
+
+        with self.reservation_lock:
+            self.reservations.pop(channel_id, None)
+        if charged_channel() == channel_id:
+            charge_to(None)
+
+
+def get_quota(api_keys = None, path = None):
+    # The quota manager shared by every thread. It is made with api_keys
+    # and path, usually config.API_KEYS and config.QUOTA_PATH, the first
+    # time it is called, or with the keys in API_KEY_PATH and QUOTA_PATH
+    # if none are given.
+    global QUOTA
+    with QUOTA_LOCK:
+        if QUOTA is None:
+            if api_keys is None:
+                api_keys = read_api_keys(API_KEY_PATH)
+            if path is None:
+                path = QUOTA_PATH
+            QUOTA = QuotaManager(api_keys, path)
+        return QUOTA
+
+def charge_to(channel_id):
+    # Take the units the calling thread spends from now on off the
+    # reservation of channel_id, or off none with None.
+    CHARGE.channel_id = channel_id
+
+def charged_channel():
+    return getattr(CHARGE, "channel_id", None)
+
+def read_api_keys(filepath):
+
+    with open(filepath, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+def key_hash(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+def quota_day():
+    return datetime.now(QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+
+def estimate_channel_cost(video_count):
+    # one playlistItems page and one videos request per 50 videos,
+    # plus the channel lookup
+    batches = max(1, math.ceil(video_count / RESULTS_PER_PAGE))
+    return (UNIT_COSTS["playlistItems"] * batches
+            + UNIT_COSTS["videos"] * batches
+            + UNIT_COSTS["channels"])
+
+def is_quota_error(json_text):
+    # True for the 403 the API sends once a key is out of quota.
+    try:
+        reasons = [error.get("reason")
+                   for error in json_text["error"]["errors"]]
+    except (KeyError, TypeError):
+        return False
+    return "quotaExceeded" in reasons or "dailyLimitExceeded" in reasons
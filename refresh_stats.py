@@ -0,0 +1,297 @@
+"""Snapshot the counts of the videos already mined, as time series.
+
+channel_scraper records the views, likes and comments of a video once,
+when it is mined, and update_data only adds new uploads. refresh_stats
+reads the video ids of every file in 'OUTPUT_PATH', requests their
+statistics again, 50 videos per request, and appends one timestamped
+snapshot per video to a SQLite database ('STATS_PATH'). The csv files are
+never rewritten.
+
+Every video has a time it is next due. Once refreshed, a video is due
+again after the interval of REFRESH_INTERVALS for its age, so recent
+videos, whose counts still grow quickly, are refreshed more often than
+old ones. A run refreshes the videos that are due, the longest overdue
+first and the newest first among those, until none is due, the quota
+runs out or it has spent 'REFRESH_MAX_UNITS'. Every batch is committed
+with its new due times, so a run that stops for any reason resumes where
+it stopped, and refreshing millions of videos is spread over as many
+days as the quota needs.
+
+The snapshots table holds one row per video and snapshot, keyed by an
+integer video number and a unix time, with one integer column per
+'RELEVANT_DATA' metric.
+
+Attributes:
+    REFRESH_INTERVALS (list of (int, int)):
+        (age, interval) pairs in seconds: a video younger than 'age' is
+        refreshed every 'interval'. The last pair covers every video.
+
+    SELECT_BATCHES (int):
+        The number of batches of due videos selected at a time, and sent
+        to the MAX_WORKERS threads.
+"""
+
+
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from api_client import ApiError, api_get
+from channel_scraper import (VIDEOS_PER_REQUEST, json_parse,
+                             statistics_fields)
+from channel_state import Transaction
+from config import load_config
+from delta_segments import list_segments
+from finish_data import get_file_list
+from metrics import get_metrics
+from output_writers import get_output_writer_for, parse_date
+from quota import UNIT_COSTS, QuotaExhausted, get_quota
+from response_cache import get_cache, print_cache_stats
+
+# variables
+DAY = 24 * 60 * 60
+REFRESH_INTERVALS = [
+    (7 * DAY, DAY),
+    (30 * DAY, 3 * DAY),
+    (365 * DAY, 14 * DAY),
+    (float("inf"), 60 * DAY),
+]
+SELECT_BATCHES = 20
+
+
+class StatsStore(object):
+
+    def __init__(self, path, relevant_data):
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.path = path
+        self.relevant_data = list(relevant_data)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout = 60,
+                                          check_same_thread = False,
+                                          isolation_level = None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        # next_refresh is NULL once a video is deleted or private
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS videos ("
+            " video INTEGER PRIMARY KEY,"
+            " vid_id TEXT NOT NULL UNIQUE,"
+            " channel_name TEXT,"
+            " published_at INTEGER,"
+            " next_refresh INTEGER)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS videos_due"
+            " ON videos (next_refresh, published_at DESC)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            " video INTEGER NOT NULL,"
+            " taken_at INTEGER NOT NULL,"
+            " PRIMARY KEY (video, taken_at)) WITHOUT ROWID")
+        # files already read, so a run only reads what changed since
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY, signature TEXT NOT NULL)")
+        columns = [row[1] for row in self.connection.execute(
+                                         "PRAGMA table_info(snapshots)")]
+        for name in self.relevant_data:
+            if name not in columns:
+                self.connection.execute(
+                    f'ALTER TABLE snapshots ADD COLUMN "{name}" INTEGER')
+
+    def transaction(self):
+        return Transaction(self)
+
+    def is_synced(self, path, signature):
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT signature FROM files WHERE path = ?",
+                (path,)).fetchone()
+        return row is not None and row[0] == signature
+
+    def add_videos(self, path, signature, rows, channel_name):
+        # Add the videos of one file, new videos are due right away.
+        with self.transaction() as connection:
+            for row in rows:
+                connection.execute(
+                    "INSERT OR IGNORE INTO videos (vid_id, channel_name,"
+                    " published_at, next_refresh) VALUES (?, ?, ?, 0)",
+                    (row[0], channel_name, unix_time(row[2])))
+            connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?)",
+                (path, signature))
+
+    def due(self, now, limit):
+        # The ids of up to 'limit' videos due at 'now', the longest
+        # overdue first, then the newest.
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT vid_id FROM videos WHERE next_refresh <= ?"
+                " ORDER BY next_refresh, published_at DESC LIMIT ?",
+                (now, limit))]
+
+    def due_count(self, now):
+
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM videos WHERE next_refresh <= ?",
+                (now,)).fetchone()[0]
+
+    def record_snapshots(self, vid_ids, stats_by_id, taken_at):
+        # Append a snapshot of every video of the batch and set when it
+        # is next due. Videos without statistics are not due anymore.
+        names = ", ".join(f'"{name}"' for name in self.relevant_data)
+        marks = ", ".join("?" for name in self.relevant_data)
+        with self.transaction() as connection:
+            for vid_id in vid_ids:
+                video, published_at = connection.execute(
+                    "SELECT video, published_at FROM videos"
+                    " WHERE vid_id = ?", (vid_id,)).fetchone()
+                data = stats_by_id.get(vid_id)
+                if data is None:
+                    connection.execute(
+                        "UPDATE videos SET next_refresh = NULL"
+                        " WHERE video = ?", (video,))
+                    continue
+                connection.execute(
+                    f"INSERT OR REPLACE INTO snapshots (video, taken_at,"
+                    f" {names}) VALUES (?, ?, {marks})",
+                    (video, taken_at, *data))
+                connection.execute(
+                    "UPDATE videos SET next_refresh = ? WHERE video = ?",
+                    (taken_at + refresh_interval(taken_at, published_at),
+                     video))
+
+    def daily_units(self, now):
+        # The units a day refreshing every video on time costs.
+        case = "CASE"
+        params = []
+        for max_age, interval in REFRESH_INTERVALS[:-1]:
+            case += " WHEN ? - COALESCE(published_at, 0) < ? THEN ?"
+            params += [now, max_age, DAY / interval]
+        case += " ELSE ? END"
+        params.append(DAY / REFRESH_INTERVALS[-1][1])
+        with self.lock:
+            refreshes = self.connection.execute(
+                f"SELECT TOTAL({case}) FROM videos"
+                " WHERE next_refresh IS NOT NULL", params).fetchone()[0]
+        return refreshes / VIDEOS_PER_REQUEST * UNIT_COSTS["videos"]
+
+
+def refresh_all_stats(config):
+    """Read the video ids of every file in the 'OUTPUT_PATH' directory
+    into the stats store, then request the statistics of the videos that
+    are due and append them to the store as snapshots.
+
+    Args:
+        config (Config): the settings of the run, see config.py. The
+                         snapshots go in its STATS_PATH, at most
+                         REFRESH_MAX_UNITS units are spent and
+                         MAX_WORKERS requests are made at once.
+    Returns:
+        int: the number of videos refreshed.
+    """
+
+    print("\n\nstarting refresh_all_stats")
+    get_metrics(config.METRICS_LOG_PATH, config.PROMETHEUS_PATH)
+    get_cache(config.CACHE_PATH)
+    store = StatsStore(config.STATS_PATH, config.RELEVANT_DATA)
+    sync_video_ids(store, config.OUTPUT_PATH)
+    now = int(time.time())
+    print(f"\n{store.due_count(now)} videos are due, refreshing every video "\
+          f"on time costs about {store.daily_units(now):.0f} units a day")
+
+    max_batches = None
+    if config.REFRESH_MAX_UNITS is not None:
+        max_batches = config.REFRESH_MAX_UNITS // UNIT_COSTS["videos"]
+    batches_done = 0
+    refreshed = 0
+    workers = max(1, config.MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        while max_batches is None or batches_done < max_batches:
+            select_batches = SELECT_BATCHES * workers
+            if max_batches is not None:
+                select_batches = min(select_batches,
+                                     max_batches - batches_done)
+            vid_ids = store.due(int(time.time()),
+                                select_batches * VIDEOS_PER_REQUEST)
+            if not vid_ids:
+                break
+            batches = [vid_ids[i:i + VIDEOS_PER_REQUEST]
+                       for i in range(0, len(vid_ids), VIDEOS_PER_REQUEST)]
+            try:
+                for count in executor.map(refresh_batch, batches,
+                                          [store] * len(batches),
+                                          [config] * len(batches)):
+                    refreshed += count
+                    batches_done += 1
+            except (QuotaExhausted, ApiError) as error:
+                # the batches left keep their due times
+                print(f"\n{error}")
+                break
+            print(f"\n{refreshed} videos refreshed")
+    print(f"\n{refreshed} videos refreshed, "\
+          f"{store.due_count(int(time.time()))} videos left to refresh")
+    return refreshed
+
+def refresh_batch(vid_ids, store, config):
+    # Snapshot the statistics of up to VIDEOS_PER_REQUEST videos. The
+    # counts are always asked for, a cached response would be recorded
+    # as a snapshot taken now.
+    params = {"part": "statistics", "id": ",".join(vid_ids),
+              "maxResults": VIDEOS_PER_REQUEST,
+              "fields": statistics_fields(config.RELEVANT_DATA)}
+    taken_at = int(time.time())
+    response = api_get("videos", params, use_cache = False)
+    stats_by_id = json_parse(response, relevant_data = config.RELEVANT_DATA)
+    store.record_snapshots(vid_ids, stats_by_id, taken_at)
+    get_metrics().count("videos_refreshed", len(stats_by_id))
+    return len(stats_by_id)
+
+def sync_video_ids(store, OUTPUT_PATH):
+    # Add the videos of the files, and their delta segments, that changed
+    # since the last run.
+    for file in get_file_list(OUTPUT_PATH):
+        channel_name = os.path.basename(file).rsplit(".",1)[0]
+        output_writer = get_output_writer_for(file)
+        for path in list_segments(file) + [file]:
+            signature = file_signature(path, output_writer)
+            if store.is_synced(path, signature):
+                continue
+            print(f"\nreading the video ids of {path}")
+            store.add_videos(path, signature, output_writer.iter_rows(path),
+                             channel_name)
+
+def file_signature(path, output_writer):
+    # changes whenever the file is rewritten or appended to
+    return f"{os.stat(path).st_mtime_ns}:{output_writer.size(path)}"
+
+def refresh_interval(now, published_at):
+    # The seconds until a video of that age is due again.
+    age = now - (published_at or 0)
+    for max_age, interval in REFRESH_INTERVALS:
+        if age < max_age:
+            return interval
+    return REFRESH_INTERVALS[-1][1]
+
+def unix_time(date):
+    # csv files hold the date as text, parquet files as a datetime
+    if not date:
+        return None
+    if not isinstance(date, datetime):
+        date = parse_date(date)
+    return int(date.timestamp())
+
+
+if __name__ == "__main__":
+    config = load_config(description = "Snapshot the counts of the videos "
+                                       "in OUTPUT_PATH as time series.")
+    get_quota(config.API_KEYS, config.QUOTA_PATH)
+    refresh_all_stats(config)
+    print_cache_stats()
+    get_metrics().flush()
@@ -0,0 +1,234 @@
+"""Persistent on-disk cache of YouTube Data API responses.
+
+api_client.api_get looks every request up in this cache before it is
+sent, and stores every successful response in it. Reruns of
+update_data.py after a crash, or of finish_data.py, then read the
+responses they already paid quota for from disk instead of the API.
+
+Responses are stored in a SQLite database, keyed by the endpoint and the
+sorted query parameters with the API key removed, so the same request
+made with another key is still a hit. Every endpoint has its own time to
+live, and when the database grows past MAX_CACHE_BYTES the least recently
+used responses are evicted.
+
+The ETag of every response is stored with it. Once a response has expired
+it is kept, and api_get sends its ETag in an 'If-None-Match' header.
+Channels and uploads pages are never fresh, so their ETag is sent on
+every revisit. If
+the API answers 304 Not Modified, the stored body is used again and its
+time to live starts over (refresh), so an unchanged page is never sent
+or parsed twice.
+
+Attributes:
+    CACHE_PATH (str):
+        The default filepath of the SQLite database, the CACHE_PATH
+        setting of config.py. An empty path turns the cache off.
+
+    MAX_CACHE_BYTES (int):
+        The most bytes of response bodies the cache should hold.
+
+    EVICT_RATIO (float):
+        The share of MAX_CACHE_BYTES eviction frees the cache down to,
+        so the puts after an eviction do not evict again at once.
+
+    CACHE_TTLS (dict of str: int):
+        The number of seconds a response is fresh for, by endpoint and
+        'part'. A response with a time to live of 0 is stored but never
+        fresh, so it is revalidated with its ETag every time. A request
+        with no entry here is never cached.
+"""
+
+
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+# variables
+CACHE_PATH = "cache/api_cache.sqlite"
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+EVICT_RATIO = 0.9
+
+DAY = 24 * 60 * 60
+CACHE_TTLS = {
+    # the uploads playlist of a channel never changes but its videoCount
+    # does, so channels are revalidated on every visit like uploads pages
+    "channels:contentDetails,statistics": 0,
+    "channels:contentDetails": 0,
+    # new uploads appear at the top of the first page at any time, so
+    # uploads pages are always revalidated, never served as fresh
+    "playlistItems:snippet": 0,
+    # the channel a video belongs to never changes
+    "videos:snippet": 365 * DAY,
+    # view and like counts change all the time
+    "videos:statistics": 60 * 60,
+}
+
+CACHE = None
+CACHE_OPENED = False
+CACHE_LOCK = threading.Lock()
+
+
+class ResponseCache(object):
+
+    def __init__(self, path, max_bytes = MAX_CACHE_BYTES):
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " endpoint TEXT NOT NULL,"
+                " body TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " stored_at REAL NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " used_at REAL NOT NULL,"
+                " etag TEXT)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_used_at"
+                " ON responses (used_at)")
+            columns = [row[1] for row in self.connection.execute(
+                                             "PRAGMA table_info(responses)")]
+            if "etag" not in columns: # made by an older version
+                self.connection.execute(
+                    "ALTER TABLE responses ADD COLUMN etag TEXT")
+        # the bytes stored, kept up to date by put instead of summing the
+        # sizes, which are stored after the bodies, on every put
+        self.total_bytes = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        # Return the body stored under key, or None if it is
+        # missing or expired.
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT body, expires_at FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            if row is None or row[1] < now:
+                self.misses += 1
+                return None
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE responses SET used_at = ? WHERE key = ?",
+                    (now, key))
+            self.hits += 1
+            return row[0]
+
+    def get_stale(self, key):
+        # Return (body, etag) of an expired response that has an ETag,
+        # or None.
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT body, etag FROM responses WHERE key = ?",
+                (key,)).fetchone()
+        if row is None or not row[1]:
+            return None
+        return row
+
+    def put(self, key, endpoint, body, ttl, etag = None):
+
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                old = self.connection.execute(
+                    "SELECT size FROM responses WHERE key = ?",
+                    (key,)).fetchone()
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES"
+                    " (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, endpoint, body, len(body), now, now + ttl, now,
+                     etag))
+            self.total_bytes += len(body) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def refresh(self, key, ttl):
+        # The API said the response did not change, it is fresh again.
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE responses SET stored_at = ?, expires_at = ?,"
+                    " used_at = ? WHERE key = ?", (now, now + ttl, now, key))
+            self.revalidated += 1
+
+    def evict(self):
+        # Delete the least recently used responses until the cache fits
+        # in EVICT_RATIO of max_bytes. Must be called holding self.lock.
+        target = self.max_bytes * EVICT_RATIO
+        with self.connection:
+            # expired responses that cannot be revalidated go first
+            self.connection.execute(
+                "DELETE FROM responses WHERE expires_at < ?"
+                " AND etag IS NULL", (time.time(),))
+            # summed again, other processes may share the database
+            total = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            rows = self.connection.execute(
+                "SELECT key, size FROM responses ORDER BY used_at")
+            evicted = []
+            for key, size in rows:
+                if total <= target:
+                    break
+                evicted.append((key,))
+                total -= size
+            self.connection.executemany(
+                "DELETE FROM responses WHERE key = ?", evicted)
+        self.total_bytes = total
+
+    def stats(self):
+
+        with self.lock:
+            entries, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0)"
+                " FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses,
+                "revalidated": self.revalidated,
+                "entries": entries, "bytes": size}
+
+
+def get_cache(path = None):
+    # The cache shared by every thread, at path, usually
+    # config.CACHE_PATH, or CACHE_PATH. None if the first call turned it
+    # off with an empty path.
+    global CACHE, CACHE_OPENED
+    with CACHE_LOCK:
+        if not CACHE_OPENED:
+            path = CACHE_PATH if path is None else path
+            if path:
+                CACHE = ResponseCache(path)
+            CACHE_OPENED = True
+        return CACHE
+
+def cache_ttl(endpoint, params):
+    # The time to live of a request, or None if it should not be cached.
+    # 0 if it should be revalidated every time.
+    return CACHE_TTLS.get(endpoint + ":" + str(params.get("part", "")))
+
+def cache_key(endpoint, params):
+    # The endpoint and the sorted params, without the API key.
+    kept = sorted((name, str(value)) for name, value in params.items()
+                  if name != "key")
+    return endpoint + "?" + urlencode(kept)
+
+def print_cache_stats():
+
+    cache = get_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print(f"\nAPI response cache: {stats['hits']} hits, "\
+              f"{stats['misses']} misses ({stats['revalidated']} not "\
+              f"modified), {stats['entries']} responses "\
+              f"({stats['bytes']} bytes) stored in {cache.path}")
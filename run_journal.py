@@ -0,0 +1,161 @@
+"""Write-ahead journal of the videos mined since the last write.
+
+channel_scraper only writes a channel's rows every 'MAX_VIDEOS' videos,
+so a run that crashed used to lose the statistics of up to MAX_VIDEOS
+videos, and request them again. Now every batch of videos is recorded
+here, with its statistics and the page it was found on, as soon as its
+videos request returns, and removed once its rows are written:
+
+    datamine_video_batch    records the batch (record_batch), and takes
+                            the videos already in the journal from it
+                            instead of requesting them again (mined)
+    csv_writer              removes the rows it wrote (clear)
+    update_data             removes them once their delta segment is
+                            committed
+
+After a crash, finish_data writes the videos the journal holds for a
+channel (pending) to its unfinished file before anything else, so paging
+resumes at the page of the last video mined, and no videos request is
+made twice.
+
+The journal also records every run of cli.py (start_run, finish_run),
+so 'python cli.py resume' knows which command was interrupted and with
+which options.
+
+Attributes:
+    JOURNAL_PATH (str):
+        The filepath of the SQLite database, unless a run gives its own
+        (see config.py). An empty path turns the journal off.
+
+    MAX_AGE (float):
+        The number of seconds the statistics of a video in the journal
+        are reused for. Older ones are requested again.
+"""
+
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from channel_state import Transaction
+
+# variables
+JOURNAL_PATH = "cache/run_journal.sqlite"
+MAX_AGE = 2 * 24 * 60 * 60
+
+JOURNAL = None
+JOURNAL_OPENED = False
+JOURNAL_LOCK = threading.Lock()
+
+
+class RunJournal(object):
+
+    def __init__(self, path):
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout = 60,
+                                          check_same_thread = False,
+                                          isolation_level = None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        # the rowid keeps the order the videos were mined in
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS videos ("
+            " vid_id TEXT NOT NULL UNIQUE,"
+            " channel_id TEXT,"
+            " page_token TEXT,"
+            " row TEXT NOT NULL,"
+            " recorded_at REAL NOT NULL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS videos_channel"
+            " ON videos (channel_id)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            " run_id INTEGER PRIMARY KEY,"
+            " command TEXT NOT NULL,"
+            " argv TEXT NOT NULL,"
+            " started_at REAL NOT NULL,"
+            " finished_at REAL)")
+
+    def transaction(self):
+        return Transaction(self)
+
+    def record_batch(self, vid_batch, channel_id = None):
+        # Record videos whose statistics were just requested.
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO videos (vid_id, channel_id,"
+                " page_token, row, recorded_at) VALUES (?, ?, ?, ?, ?)",
+                [(vid.get_vid_id(), channel_id, vid.page_token,
+                  json.dumps(vid.get_data()), now) for vid in vid_batch])
+
+    def mined(self, vid_ids):
+        # {vid_id: row} of the videos of vid_ids in the journal, mined
+        # less than MAX_AGE ago.
+        vid_ids = list(vid_ids)
+        marks = ", ".join("?" for vid_id in vid_ids)
+        with self.lock:
+            return {vid_id: json.loads(row)
+                    for vid_id, row in self.connection.execute(
+                        f"SELECT vid_id, row FROM videos"
+                        f" WHERE vid_id IN ({marks}) AND recorded_at > ?",
+                        vid_ids + [time.time() - MAX_AGE])}
+
+    def pending(self, channel_id):
+        # [(row, page_token)] of the videos of a channel mined but not
+        # written yet, in the order they were mined.
+        with self.lock:
+            return [(json.loads(row), page_token)
+                    for row, page_token in self.connection.execute(
+                        "SELECT row, page_token FROM videos"
+                        " WHERE channel_id = ? ORDER BY rowid",
+                        (channel_id,))]
+
+    def clear(self, vid_ids):
+        # Remove videos whose rows were written.
+        with self.transaction() as connection:
+            connection.executemany("DELETE FROM videos WHERE vid_id = ?",
+                                   [(vid_id,) for vid_id in vid_ids])
+
+    def start_run(self, command, argv):
+
+        with self.transaction() as connection:
+            return connection.execute(
+                "INSERT INTO runs (command, argv, started_at)"
+                " VALUES (?, ?, ?)",
+                (command, json.dumps(argv), time.time())).lastrowid
+
+    def finish_run(self, run_id):
+
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE runs SET finished_at = ? WHERE run_id = ?",
+                (time.time(), run_id))
+
+    def interrupted_runs(self):
+        # [(run_id, command, argv)] of the runs that never finished,
+        # oldest first.
+        with self.lock:
+            return [(run_id, command, json.loads(argv))
+                    for run_id, command, argv in self.connection.execute(
+                        "SELECT run_id, command, argv FROM runs"
+                        " WHERE finished_at IS NULL ORDER BY run_id")]
+
+
+def get_journal(path = None):
+    # The journal shared by every thread, at path, or JOURNAL_PATH. None
+    # if the first call turned it off with an empty path.
+    global JOURNAL, JOURNAL_OPENED
+    with JOURNAL_LOCK:
+        if not JOURNAL_OPENED:
+            path = JOURNAL_PATH if path is None else path
+            if path:
+                JOURNAL = RunJournal(path)
+            JOURNAL_OPENED = True
+        return JOURNAL
@@ -1,31 +1,66 @@
 """update all files in the 'OUTPUT_PATH' directory with new videos.
 
 For each file in the 'OUTPUT_PATH' directory, open them and find up to 10 sample videos IDs
-(in case one or more videos have been deleted). Use the video IDs to find the channel ID.
-The first video ID which returns an API request will be the 'first video'. Any videos
-uploaded before that 'first video' will be added to the top of the csv file.
+(in case one or more videos have been deleted). Any videos uploaded after the
+newest of them still in the channel's uploads will be added on top of the csv
+file, in a delta segment (see delta_segments.py). Videos known to be deleted
+or private (tombstones, see channel_state.py) are left out of the samples,
+and if every sample was deleted since, the videos published after the newest
+row of the file are added, instead of every upload of the channel.
+
+The channel and uploads playlist of every file are kept in the channel
+state store (see channel_state.py). Only files of channels it has never
+seen are looked up with the API, 50 files per videos request, and their
+uploads playlists 50 channels per channels request. The channels are then
+updated MAX_WORKERS at a time.
+
+The settings of the run are loaded once at startup, see config.py.
 
 Attributes:
-    Imported from channel_scraper
+    IDS_PER_REQUEST (int):
+        The most ids the API accepts in one videos or channels request.
+
+    SAMPLE_SIZE (int):
+        The number of newest videos of a file looked for in the uploads.
 """
 
 
-import requests
-import json
-import csv
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+from itertools import chain, islice
+from api_client import ApiError, api_get
+from channel_scraper import (VIDEO_CHANNEL_FIELDS, datamine_channel,
+                             iter_upload_pages)
+from channel_state import get_store
+from config import load_config
+from delta_segments import (commit_segment, compact_if_needed,
+                            discard_uncommitted_segments, iter_rows,
+                            new_segment_path)
 from finish_data import get_file_list
-from channel_scraper import *
+from metrics import get_metrics, timed
+from output_writers import get_output_writer_for, parse_date
+from quota import get_quota
+from response_cache import get_cache, print_cache_stats
+from run_journal import get_journal
 
-def update_all_data(OUTPUT_PATH):
+# variables
+IDS_PER_REQUEST = 50
+SAMPLE_SIZE = 10
+
+def update_all_data(config):
     """For each file in the 'OUTPUT_PATH' directory, open the file
-    and find the first video that has not been deleted. Use that 'first_vid_id'
-    to make an API request to find the channel link. Make an API request to get
-    all uploads by the channel, and only record up to the 'first_vid_id'. Add
-    those new uploads to the top of the csv file in the same directory.
+    and read the ids of its newest videos. Find the channel and uploads
+    playlist of every file, from the channel state store or with batched
+    API requests. Then page through the uploads of each channel, MAX_WORKERS
+    channels at a time, and only record up to the newest video already in
+    the file. Add those new uploads to a new delta segment of the csv file
+    (see delta_segments.py), which is merged into the csv file once the
+    segments have grown large enough.
 
     Args:
-        OUTPUT_PATH (str): The directory where the completed data should go.
+        config (Config): the settings of the run, see config.py. The
+                         completed data is in its OUTPUT_PATH.
     Returns:
         None
     Output:
@@ -33,95 +68,239 @@ def update_all_data(OUTPUT_PATH):
     """
 
     print("\n\nstarting update_all_data")
-    file_list = get_file_list(OUTPUT_PATH)
+    get_metrics(config.METRICS_LOG_PATH, config.PROMETHEUS_PATH)
+    get_cache(config.CACHE_PATH)
+    get_store(config.COMPLETED_LINKS_FILEPATH, config.CHANNEL_STATE_PATH)
+    get_journal(config.JOURNAL_PATH)
+    file_list = get_file_list(config.OUTPUT_PATH)
+    vid_id_lists = {}
     for file in file_list:
-        print(f"\nOn file {file}")
-        vid_id_list = get_first_vid_id(file)
-        channel_link, first_vid_id = get_channel_link(vid_id_list)
-        new_vid_list = find_new_channel_vids(channel_link, first_vid_id)
-        for finished_vid_list in datamine_channel(new_vid_list):
-            print(f"\nlen(new_vid_list) = {len(new_vid_list)}")
-            csv_updater(finished_vid_list,file)
-
-def find_new_channel_vids(channel_link, first_vid_id):
-
-    # Very similar functionality to find_channel_vids in channel_scraper.py
-    playlist_id, channel_id = request_channel_list_response(channel_link)
-    video_items = []
-    next_page_token = '&'
-    found = False
-    while not found:
-        new_video_items, next_page_token, channel_name = find_all_uploads(playlist_id, next_page_token)
-        video_items += new_video_items
-        found, video_items = check_vid_id(video_items, first_vid_id)
-
-        if len(video_items)%500 == 0:
-            print(f"\n{len(video_items)} new videos found... looking for more")
-
-    print(f"\n{len(video_items)} new videos found")
-    vid_list = []
-    for item in video_items:
-        vid_id, title, date, thumbnail = json_parse(item,playlist_items = True)
-        vid_list.append(Video(vid_id,title,date,thumbnail))
-    return vid_list
-
-def check_vid_id(video_items, first_vid_id):
-
-    for i in range(len(video_items)):
-        vid_id = video_items[i]['snippet']['resourceId']['videoId']
-        if vid_id == first_vid_id:
-            return True, video_items[:i]
-    return False, video_items
-
-
-def get_channel_link(vid_id_list, counter = 0):
-
-    api_link = "https://www.googleapis.com/youtube/v3/videos?part=snippet" \
-               f"&id={vid_id_list[counter]}&key={API_KEY}"
-    video_snippet_response = requests.get(api_link).json()
-    try:
-        channel_id = video_snippet_response['items'][0]['snippet']['channelId']
-    except IndexError:
-        print(f"\n\nIndexError\ncounter = {counter}")
-        return get_channel_link(vid_id_list,counter = counter + 1)
-    channel_link = "https://www.youtube.com/channel/" + channel_id
-    return channel_link, vid_id_list[counter]
+        discard_uncommitted_segments(file)
+        vid_id_lists[file] = get_first_vid_id(file)
+    channel_ids = find_channel_ids(vid_id_lists)
+    playlist_ids = find_playlist_ids(set(channel_ids.values()))
+
+    updates = []
+    for file in file_list:
+        playlist_id = playlist_ids.get(channel_ids.get(file))
+        if playlist_id is None:
+            print(f"\nno channel found for {file}, skipping it")
+            continue
+        updates.append((file, playlist_id, vid_id_lists[file]))
+    print(f"\nupdating {len(updates)} channels")
+
+    if config.MAX_WORKERS <= 1:
+        for update in updates:
+            update_channel_file(*update, config)
+        return
+    with ThreadPoolExecutor(max_workers = config.MAX_WORKERS) as executor:
+        futures = [executor.submit(update_channel_file, *update, config)
+                   for update in updates]
+        for future in as_completed(futures):
+            # re-raise any error from the worker thread
+            future.result()
+
+def update_channel_file(file, playlist_id, vid_id_list, config):
+    # Add the videos uploaded since the newest video of file to a delta
+    # segment, safe to run from several threads for different files.
+    print(f"\nOn file {file}")
+    new_vid_list = find_new_channel_vids(playlist_id,
+                                         get_sample_dates(file, vid_id_list),
+                                         get_newest_date(file))
+    # A channel with no new uploads stops at its first page, which is
+    # usually a 304 answered from the response cache (see api_client.py).
+    # Nothing else is done for it.
+    first_vid = next(new_vid_list, None)
+    if first_vid is None:
+        return
+    new_vid_list = chain([first_vid], new_vid_list)
+    # the new videos of this pass all go in one delta segment, which
+    # only becomes visible once every one of them is written
+    segment_path = new_segment_path(file)
+    written = []
+    for finished_vid_list in datamine_channel(new_vid_list, config):
+        print(f"\n{len(finished_vid_list)} new videos mined")
+        csv_updater(finished_vid_list,file,segment_path)
+        written += [vid.get_vid_id() for vid in finished_vid_list]
+    commit_segment(segment_path)
+    # until the segment is committed, a crashed update is redone with
+    # the statistics in the run journal
+    journal = get_journal()
+    if journal is not None:
+        journal.clear(written)
+    compact_if_needed(file)
+
+def find_new_channel_vids(playlist_id, vid_dates, newest_date = None):
+    # Generator of the videos uploaded after the newest video of
+    # vid_dates, {vid_id: date} of the samples of a file, still in the
+    # uploads, or after newest_date if they were all deleted. Similar to find_channel_vids in
+    # channel_scraper.py, but pages are not requested ahead, since the
+    # newest video is usually found on the first page.
+    counter = 0
+    for page in iter_upload_pages(playlist_id, '&'):
+        found, new_vids = check_vid_id(page, vid_dates, newest_date)
+        counter += len(new_vids)
+        yield from new_vids
+        if found:
+            break
+        if counter % 500 == 0:
+            print(f"\n{counter} new videos found... looking for more")
+    print(f"\n{counter} new videos found")
+
+def check_vid_id(vid_list, known_dates, newest_date = None):
+    # The videos of vid_list before the first one in known_dates,
+    # {vid_id: date}, deleted videos are not in vid_list, so any known
+    # video will do. The videos published before newest_date are known
+    # too.
+    for i in range(len(vid_list)):
+        vid_id = vid_list[i].get_vid_id()
+        if vid_id in known_dates:
+            return True, vid_list[:i]
+        date = parse_date(vid_list[i].date)
+        if newest_date is not None and date < newest_date:
+            print(f"\nnone of the newest videos of the file are in the "\
+                  f"uploads anymore, {i} videos are newer than them")
+            # only the samples at least as new as vid_list[i] would have
+            # been found before it, the older ones may be further down
+            missing = [known_id for known_id, known_date
+                       in known_dates.items()
+                       if known_date is not None and known_date >= date]
+            if missing:
+                get_store().record_tombstones(missing, "not in the uploads")
+            return True, vid_list[:i]
+    return False, vid_list
+
+def find_channel_ids(vid_id_lists):
+    # {file: channel id} of the files in vid_id_lists. Channels already
+    # in the channel state store are not looked up. The others are, with
+    # one video of up to IDS_PER_REQUEST files per videos request, and
+    # the next video of a file if that one was deleted.
+    store = get_store()
+    channel_ids = {}
+    unresolved = {}
+    for file, vid_id_list in vid_id_lists.items():
+        state = store.find_by_name(channel_name_of(file))
+        if state is not None:
+            channel_ids[file] = state["channel_id"]
+        elif vid_id_list:
+            unresolved[file] = list(vid_id_list)
+    if unresolved:
+        print(f"\nlooking up the channels of {len(unresolved)} files")
+
+    while unresolved:
+        candidates = [(file, vid_id_list.pop(0))
+                      for file, vid_id_list in unresolved.items()]
+        for i in range(0, len(candidates), IDS_PER_REQUEST):
+            batch = candidates[i:i + IDS_PER_REQUEST]
+            params = {"part": "snippet",
+                      "id": ",".join(vid_id for file, vid_id in batch),
+                      "maxResults": IDS_PER_REQUEST,
+                      "fields": VIDEO_CHANNEL_FIELDS}
+            response = api_get("videos", params)
+            if "items" not in response:
+                # an error body, not a sign the videos are gone
+                raise ApiError(f"videos request failed: {response}")
+            found = {item["id"]: item["snippet"]["channelId"]
+                     for item in response["items"]}
+            for file, vid_id in batch:
+                if vid_id in found:
+                    channel_ids[file] = found[vid_id]
+                    store.record_channel_name(found[vid_id],
+                                              channel_name_of(file))
+                    del unresolved[file]
+            deleted = [vid_id for file, vid_id in batch
+                       if vid_id not in found]
+            if deleted:
+                store.record_tombstones(deleted, "not found")
+        for file in [file for file, vid_id_list in unresolved.items()
+                     if not vid_id_list]:
+            print(f"\nevery sample video of {file} was deleted")
+            del unresolved[file]
+    return channel_ids
+
+def find_playlist_ids(channel_ids):
+    # {channel id: uploads playlist id}. Playlists already in the channel
+    # state store are not looked up, the others are, IDS_PER_REQUEST
+    # channels per channels request.
+    store = get_store()
+    playlist_ids = {}
+    unknown = []
+    for channel_id in channel_ids:
+        state = store.get(channel_id)
+        if state is not None and state["playlist_id"]:
+            playlist_ids[channel_id] = state["playlist_id"]
+        else:
+            unknown.append(channel_id)
+    for i in range(0, len(unknown), IDS_PER_REQUEST):
+        params = {"part": "contentDetails",
+                  "id": ",".join(unknown[i:i + IDS_PER_REQUEST]),
+                  "maxResults": IDS_PER_REQUEST,
+                  "fields": "etag,items(id,contentDetails/relatedPlaylists"
+                            "/uploads)"}
+        response = api_get("channels", params)
+        for item in response.get("items", []):
+            playlist_id = item['contentDetails'] \
+                              ['relatedPlaylists']['uploads']
+            playlist_ids[item["id"]] = playlist_id
+            store.mark_queued(item["id"], playlist_id)
+    return playlist_ids
+
+def channel_name_of(file):
+    # data/Dude_Perfect.csv -> Dude_Perfect
+    return os.path.basename(file).rsplit(".",1)[0]
 
 def get_first_vid_id(filename):
 
-    with open(filename,'r') as file:
-        header_line = file.readline()
-        counter = 0
-        vid_id_list = [] # necessary to have mulitple vid_id's
-                         # in case the channel has deleted videos
-        for line in file:
-            vid_id_list.append(line.split(",",1)[0])
-            if counter > 9:
-                return vid_id_list
-        return vid_id_list
-        
-
-def csv_updater(finished_vid_list, filepath):
-    row_list = []
-
-    with open(filepath,'r') as file:
-        for line in file:
-            row_list.append(line)
-    temp_filepath = filepath.rsplit(".",1)[0] + "__temp.csv"
-
-    with open(temp_filepath, 'w') as file:
-        writer = csv.writer(file)
-        file.write(row_list[0])
-        for vid in finished_vid_list:
-            vid_data = vid.get_data()
-            writer.writerow(vid_data)
-        file.writelines(row_list[1:])
-    os.remove(filepath)
-    os.rename(temp_filepath, filepath)
+    # necessary to have mulitple vid_id's in case the channel has deleted
+    # videos. The newest videos are in the newest delta segment, if any.
+    # Only the first rows are read, and the file is closed right after.
+    # Videos known to be deleted are skipped.
+    with closing(iter_rows(filename)) as rows:
+        vid_id_list = [row[0] for row in islice(rows, 5 * SAMPLE_SIZE)]
+    tombstoned = get_store().tombstoned(vid_id_list)
+    return [vid_id for vid_id in vid_id_list
+            if vid_id not in tombstoned][:SAMPLE_SIZE]
+
+def get_sample_dates(filename, vid_id_list):
+    # {vid_id: date} of the videos of vid_id_list, the samples of
+    # get_first_vid_id, as datetimes, None for a row without a date.
+    vid_ids = set(vid_id_list)
+    sample_dates = {}
+    with closing(iter_rows(filename)) as rows:
+        for row in islice(rows, 5 * SAMPLE_SIZE):
+            if row[0] in vid_ids:
+                sample_dates[row[0]] = parse_date(row[2]) if row[2] \
+                                       else None
+    return sample_dates
+
+def get_newest_date(filename):
+    # The date of the newest video of a file, as a datetime.
+    with closing(iter_rows(filename)) as rows:
+        row = next(rows, None)
+    if row is None or not row[2]:
+        return None
+    return parse_date(row[2])
+
+
+@timed("csv_updater")
+def csv_updater(finished_vid_list, filepath, segment_path):
+    # Append the rows to the delta segment of filepath being written.
+    # Only the new rows are written, filepath itself is not touched.
+    if not finished_vid_list:
+        return
+    output_writer = get_output_writer_for(filepath)
+    output_writer.append(segment_path, output_writer.header(filepath),
+                         finished_vid_list)
+    get_metrics().count("rows_written", len(finished_vid_list),
+                        output_format = output_writer.extension[1:])
 
 
 
 if __name__ == "__main__":
-    API_KEY = get_api_key()
-    update_all_data(OUTPUT_PATH)
-    print(f"\n\nAll files in directory:  {OUTPUT_PATH}  updated")
+    config = load_config(description = "Update all files in OUTPUT_PATH "
+                                       "with new videos.")
+    get_quota(config.API_KEYS, config.QUOTA_PATH)
+    update_all_data(config)
+    print(f"\n\nAll files in directory:  {config.OUTPUT_PATH}  updated")
+    print_cache_stats()
+    get_metrics().flush()
@@ -0,0 +1,257 @@
+"""Work queue of the channel links waiting to be data-mined.
+
+channel_scraper used to take the first line of 'CHANNEL_LINKS_TEXT_FILEPATH'
+and rewrite the whole file without it for every channel. This module
+treats that text file as an append-only journal instead: new lines are
+read from a persisted byte offset (the cursor) into a SQLite queue table,
+and the text file is never rewritten. Links can be appended to the file at
+any time and are picked up by the next call to sync_file.
+
+Taking the next link from the queue (claim) is one indexed lookup and one
+update in a single transaction, so any number of threads or processes can
+consume the same queue without taking the same link twice. A claimed link
+is only marked done once its channel has been handled, so after a crash a
+worker puts its unfinished claims back with requeue_claims and resumes
+where it stopped.
+
+Several machines can share one queue, the coordinator, by pointing
+'WORK_QUEUE_PATH' at the same database. A claim is a lease: it expires
+LEASE_SECONDS after it was taken unless its worker renews it with
+heartbeat, and claim hands links whose lease expired, e.g. because their
+machine died, to another worker. A link can also be put back for later
+(release with not_before), when another worker holds its channel.
+
+Only one process at a time may run under a worker id (register): two
+processes of one machine sharing the default id would otherwise take
+back each other's claims and mine the same channel into the same file.
+A second process is refused while the first is alive, checked by its
+pid on the same machine and by its heartbeat elsewhere, so a rerun after
+a crash keeps the id and its claims.
+
+Attributes:
+    WORK_QUEUE_PATH (str):
+        The filepath of the SQLite database.
+
+    LEASE_SECONDS (float):
+        The number of seconds a claim lasts without a heartbeat.
+"""
+
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from channel_state import Transaction
+
+# variables
+WORK_QUEUE_PATH = "channel_links/work_queue.sqlite"
+LEASE_SECONDS = 600
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+
+QUEUE = None
+QUEUE_LOCK = threading.Lock()
+
+
+class WorkerIdInUse(Exception):
+    """Another live process runs under the same WORKER_ID."""
+
+
+class WorkQueue(object):
+
+    def __init__(self, path):
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout = 60,
+                                          check_same_thread = False,
+                                          isolation_level = None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS links ("
+            " position INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " channel_link TEXT NOT NULL UNIQUE,"
+            " status TEXT NOT NULL,"
+            " claimed_by TEXT,"
+            " claimed_at REAL,"
+            " lease_expires REAL,"
+            " available_at REAL)")
+        columns = [row[1] for row in self.connection.execute(
+                                         "PRAGMA table_info(links)")]
+        for column in ("lease_expires REAL", "available_at REAL"):
+            if column.split()[0] not in columns: # made by an older version
+                self.connection.execute(
+                    f"ALTER TABLE links ADD COLUMN {column}")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS links_status"
+            " ON links (status, position)")
+        # the process running under each worker id
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            " worker_id TEXT PRIMARY KEY,"
+            " hostname TEXT NOT NULL,"
+            " pid INTEGER NOT NULL,"
+            " heartbeat_at REAL NOT NULL)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cursors ("
+            " filepath TEXT PRIMARY KEY, byte_offset INTEGER NOT NULL)")
+
+    def sync_file(self, filepath):
+        # Enqueue the lines appended to filepath since the last call.
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT byte_offset FROM cursors WHERE filepath = ?",
+                (filepath,)).fetchone()
+            offset = row[0] if row else 0
+            if offset > os.path.getsize(filepath):
+                # the file was rewritten, links already queued are ignored
+                offset = 0
+            with open(filepath, "rb") as file:
+                file.seek(offset)
+                for line in file:
+                    channel_link = line.decode("utf-8").strip()
+                    if channel_link:
+                        connection.execute(
+                            "INSERT OR IGNORE INTO links (channel_link,"
+                            " status) VALUES (?, ?)",
+                            (channel_link, PENDING))
+                offset = file.tell()
+            connection.execute(
+                "INSERT OR REPLACE INTO cursors VALUES (?, ?)",
+                (filepath, offset))
+
+    def claim(self, worker_id):
+        # Take the oldest link whose lease expired, or else the oldest
+        # pending link, or return None if there is none.
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT position, channel_link FROM links"
+                " WHERE status = ? AND lease_expires < ?"
+                " ORDER BY position LIMIT 1", (CLAIMED, now)).fetchone()
+            if row is None:
+                row = connection.execute(
+                    "SELECT position, channel_link FROM links"
+                    " WHERE status = ? AND COALESCE(available_at, 0) <= ?"
+                    " ORDER BY position LIMIT 1", (PENDING, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE links SET status = ?, claimed_by = ?,"
+                " claimed_at = ?, lease_expires = ? WHERE position = ?",
+                (CLAIMED, worker_id, now, now + LEASE_SECONDS, row[0]))
+            return row
+
+    def heartbeat(self, worker_id):
+        # Renew the leases of every link worker_id has claimed.
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE links SET lease_expires = ?"
+                " WHERE status = ? AND claimed_by = ?",
+                (now + LEASE_SECONDS, CLAIMED, worker_id))
+            connection.execute(
+                "UPDATE workers SET heartbeat_at = ? WHERE worker_id = ?"
+                " AND hostname = ? AND pid = ?",
+                (now, worker_id, socket.gethostname(), os.getpid()))
+
+    def register(self, worker_id):
+        # Record this process as the one running under worker_id. Raises
+        # WorkerIdInUse if another process still alive already is.
+        hostname = socket.gethostname()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT hostname, pid, heartbeat_at FROM workers"
+                " WHERE worker_id = ?", (worker_id,)).fetchone()
+            if row is not None and tuple(row[:2]) != (hostname, os.getpid()) \
+                    and is_alive(*row):
+                raise WorkerIdInUse(f"Process {row[1]} on {row[0]} already "\
+                                    f"runs as worker {worker_id}, give this "\
+                                    "run another WORKER_ID")
+            connection.execute(
+                "INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?)",
+                (worker_id, hostname, os.getpid(), time.time()))
+
+    def unregister(self, worker_id):
+
+        with self.transaction() as connection:
+            connection.execute(
+                "DELETE FROM workers WHERE worker_id = ? AND hostname = ?"
+                " AND pid = ?", (worker_id, socket.gethostname(), os.getpid()))
+
+    def complete(self, position):
+
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE links SET status = ? WHERE position = ?",
+                (DONE, position))
+
+    def release(self, position, not_before = None):
+        # Put a claimed link back at its place in the queue, not to be
+        # claimed again before the unix time not_before if it is given.
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE links SET status = ?, claimed_by = NULL,"
+                " claimed_at = NULL, lease_expires = NULL,"
+                " available_at = ? WHERE position = ?",
+                (PENDING, not_before, position))
+
+    def requeue_claims(self, worker_id):
+        # Put back the links a crashed run of worker_id left claimed.
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE links SET status = ?, claimed_by = NULL,"
+                " claimed_at = NULL, lease_expires = NULL"
+                " WHERE status = ? AND claimed_by = ?",
+                (PENDING, CLAIMED, worker_id))
+            return cursor.rowcount
+
+    def pending_count(self):
+
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM links WHERE status = ?",
+                (PENDING,)).fetchone()[0]
+
+    def transaction(self):
+        return Transaction(self)
+
+
+def get_queue(path = None):
+    # The queue shared by every thread, at path, or WORK_QUEUE_PATH,
+    # the first time it is called.
+    global QUEUE
+    with QUEUE_LOCK:
+        if QUEUE is None:
+            QUEUE = WorkQueue(path or WORK_QUEUE_PATH)
+        return QUEUE
+
+def default_worker_id():
+    # Workers on the same machine share an id, so a rerun after a crash
+    # can requeue the links the crashed run had claimed. register keeps
+    # two of them from running at once.
+    return socket.gethostname()
+
+def is_alive(hostname, pid, heartbeat_at):
+    # Whether the process registered under a worker id still runs. One
+    # of this machine is looked up by its pid, so a rerun right after a
+    # crash is not refused, one of another machine by its heartbeat.
+    if hostname == socket.gethostname():
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError: # alive, run by another user
+            return True
+        except OSError: # no signals, e.g. on Windows
+            pass
+        else:
+            return True
+    return heartbeat_at > time.time() - LEASE_SECONDS